@@ -1,16 +1,86 @@
 import subprocess
 import os
 import pathlib
+import stat
 
 import _repos_logging
 logger = _repos_logging.logger
 
+def _stat(path):
+    try:
+        return os.stat(path)
+    except (OSError, ValueError):
+        return None
+
+def is_git_dir(path):
+    """ Check if path has the layout of a git directory (a bare repo or the
+    .git directory of a repo): a HEAD file and objects and refs directories.
+    The packed-refs file is not required since a new repo doesn't have one. """
+    st = _stat(os.path.join(path, 'HEAD'))
+    if st is None or not stat.S_ISREG(st.st_mode):
+        return False
+    st = _stat(os.path.join(path, 'objects'))
+    if st is None or not stat.S_ISDIR(st.st_mode):
+        return False
+    st = _stat(os.path.join(path, 'refs'))
+    return st is not None and stat.S_ISDIR(st.st_mode)
+
+def is_git_repo(path):
+    """ Check if path is the top of a git working tree or a bare repo.
+
+    Only the few paths that matter are looked at with stat instead of listing
+    the directory which can be very expensive for big directories.  A
+    directory that is not a repo costs two stats.
+
+    A '.git' can be a directory or, for worktrees and submodules, a file
+    containing 'gitdir: <path>'. """
+    dotgit = os.path.join(path, '.git')
+    st = _stat(dotgit)
+    if st is not None:
+        if stat.S_ISDIR(st.st_mode):
+            return True
+        if stat.S_ISREG(st.st_mode):
+            try:
+                with open(dotgit, 'rb') as f:
+                    return f.read(8) == b'gitdir: '
+            except OSError:
+                return False
+    return is_git_dir(path)
+
+def get_git_dirs(path):
+    """ Return (git_dir, common_dir) of the repo at path or None.  git_dir
+    has the HEAD and index of the working tree and common_dir has the refs
+    and packed-refs.  They are the same except for linked worktrees. """
+    dotgit = os.path.join(path, '.git')
+    st = _stat(dotgit)
+    if st is not None and stat.S_ISDIR(st.st_mode):
+        git_dir = dotgit
+    elif st is not None and stat.S_ISREG(st.st_mode):
+        try:
+            with open(dotgit) as f:
+                content = f.read().strip()
+        except OSError:
+            return None
+        if not content.startswith('gitdir: '):
+            return None
+        git_dir = os.path.join(path, content[len('gitdir: '):])
+    elif is_git_dir(path):
+        git_dir = path
+    else:
+        return None
+    try:
+        with open(os.path.join(git_dir, 'commondir')) as f:
+            common_dir = os.path.join(git_dir, f.read().strip())
+    except OSError:
+        common_dir = git_dir
+    return os.path.normpath(git_dir), os.path.normpath(common_dir)
+
 def get_repo_root(d=None):
     p = pathlib.Path(d).absolute()
-    lastgit = p if p.joinpath('.git').is_dir() else None
+    lastgit = p if is_git_repo(p) else None
     for x in p.parents:
         logger.debug(f"Checking path {x}")
-        if x.joinpath('.git').is_dir():
+        if is_git_repo(x):
             lastgit = x
     return lastgit
     # while True:
@@ -24,6 +94,13 @@ def get_repo_root(d=None):
     #         return cur
     #     p.pop()
 
+def get_cache_dir():
+    """ Directory for the cache files of the repos tools, created if needed """
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    d = os.path.join(base, 'repos')
+    os.makedirs(d, exist_ok=True)
+    return d
+
 if __name__ == "__main__":
     print(get_repo_root(os.path.dirname(__file__)))
 
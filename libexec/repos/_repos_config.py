@@ -0,0 +1,361 @@
+import os
+import contextlib
+import fcntl
+import hashlib
+import pickle
+import tempfile
+import time
+
+import yaml
+
+import _repos_base
+import _repos_logging
+logger = _repos_logging.logger
+
+# The libyaml based loader and dumper are many times faster than the pure
+# Python ones but are only there if PyYAML was built with libyaml.
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+
+DEFAULT_REPO_FILE = os.path.expanduser("~/.config/repos.yml")
+
+# Where the 'repos' section is stored, selected by 'backend' in the 'config'
+# section of the file.
+BACKENDS = ('yaml', 'sqlite')
+
+CACHE_VERSION = 2
+# A file modified this recently could be modified again without its mtime
+# changing so it is not put in the cache.
+RACY_SECONDS = 2
+
+def get_repo_file(repo_file=None):
+    return repo_file if repo_file else DEFAULT_REPO_FILE
+
+def parse(text_or_stream):
+    return yaml.load(text_or_stream, Loader=SafeLoader)
+
+def dump(config, stream=None):
+    return yaml.dump(config, stream, Dumper=SafeDumper)
+
+def _cache_key(st):
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+def _cache_file(repo_file, kind):
+    h = hashlib.sha1(os.path.realpath(repo_file).encode()).hexdigest()[:16]
+    return os.path.join(_repos_base.get_cache_dir(), f"{kind}-{h}.pickle")
+
+def _read_cache(repo_file, kind):
+    """ Return the cached data for repo_file or None, the 'key' of the data
+    has to be checked by the caller """
+    try:
+        with open(_cache_file(repo_file, kind), 'rb') as f:
+            data = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.debug(f"Ignoring unreadable {kind} cache for '{repo_file}': {e}")
+        return None
+    if not isinstance(data, dict) or data.get('version') != CACHE_VERSION:
+        return None
+    return data
+
+def _write_cache(repo_file, kind, st, value, trusted=False, **extra):
+    """ Store value, and the items of extra, in the cache with the key of the
+    config file.  Unless the caller is the one who just wrote the file
+    (trusted), nothing is stored for a file that was modified too recently. """
+    if not trusted and time.time() - st.st_mtime < RACY_SECONDS:
+        return
+    try:
+        cache_file = _cache_file(repo_file, kind)
+        tmp = f"{cache_file}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            pickle.dump({'version': CACHE_VERSION, 'key': _cache_key(st), kind: value, **extra},
+                        f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, cache_file)
+    except OSError as e:
+        logger.debug(f"Could not write {kind} cache for '{repo_file}': {e}")
+
+class RepoIndex:
+    """ Map the paths and basenames of repos to their names.
+
+    The real path of each repo is computed once and kept with the path it
+    was computed from so that updating the index after the config changes
+    only resolves the paths that changed.  The index is saved in the cache
+    directory next to the compiled config and is updated each time the
+    config is written through transaction().
+
+    Real paths are only resolved again when the path of a repo changes in
+    the config.  A real path found by a lookup is checked again so that a
+    symlink that now points elsewhere doesn't give a wrong answer, but the
+    new target of such a symlink is not found until the path of the repo is
+    changed or the index in the cache directory is removed. """
+    def __init__(self, paths=None):
+        # name -> (path, realpath)
+        self.paths = dict(paths) if paths else {}
+        self._build()
+
+    def _build(self):
+        self.by_path = {}
+        self.by_basename = {}
+        for name, (path, real) in sorted(self.paths.items()):
+            self.by_path.setdefault(os.path.normpath(path), name)
+            self.by_path.setdefault(real, name)
+            self.by_basename.setdefault(os.path.basename(real), []).append(name)
+
+    def update(self, repos):
+        paths = {}
+        for name, repo in repos.items():
+            path = repo.get('path') if isinstance(repo, dict) else None
+            if not path:
+                continue
+            path = os.path.expanduser(path)
+            old = self.paths.get(name)
+            if old is not None and old[0] == path:
+                paths[name] = old
+            else:
+                paths[name] = (path, os.path.realpath(path))
+        self.paths = paths
+        self._build()
+
+    def _check(self, name, p):
+        """ name if p is still the path or the real path of the repo name """
+        path, _ = self.paths[name]
+        if p == os.path.normpath(path) or os.path.realpath(path) == p:
+            return name
+        return None
+
+    def find_by_path(self, path):
+        """ Name of the repo at path or None """
+        path = os.path.abspath(os.path.expanduser(path))
+        for p in (path, os.path.realpath(path)):
+            name = self.by_path.get(p)
+            if name is not None and self._check(name, p) is not None:
+                return name
+        return None
+
+    def find_containing(self, path):
+        """ Name of the repo containing path or None.  The innermost repo is
+        returned if repos are nested. """
+        path = os.path.abspath(os.path.expanduser(path))
+        for p in (path, os.path.realpath(path)):
+            while True:
+                name = self.by_path.get(p)
+                if name is not None and self._check(name, p) is not None:
+                    return name
+                parent = os.path.dirname(p)
+                if parent == p:
+                    break
+                p = parent
+        return None
+
+    def find_by_basename(self, basename):
+        """ Names of the repos whose real path has this basename """
+        return list(self.by_basename.get(basename, []))
+
+def create(repo_file):
+    """ Create an empty config file if it doesn't exist """
+    if not os.path.isfile(repo_file):
+        os.makedirs(os.path.dirname(os.path.abspath(repo_file)), exist_ok=True)
+        with open(repo_file, 'w') as f:
+            f.write('repos: {}\n')
+
+def _load_yaml(repo_file, create_missing=False):
+    if create_missing:
+        create(repo_file)
+    with open(repo_file, 'rb') as f:
+        st = os.fstat(f.fileno())
+        data = _read_cache(repo_file, 'config')
+        if data is not None and data['key'] == _cache_key(st):
+            return data['config']
+        config = parse(f)
+    if config is None:
+        config = {}
+    if config.get('repos') is None:
+        config['repos'] = {}
+    _write_cache(repo_file, 'config', st, config)
+    return config
+
+def load(repo_file=None, create_missing=False, read_only=False):
+    """ Load the config file.
+
+    The parsed config is kept in a binary cache in ~/.cache/repos keyed on the
+    device, inode, size and mtime of the file so that a file that has not
+    changed since the last time it was loaded is not parsed again.  Each call
+    returns a new object that the caller is free to modify.
+
+    With the SQLite backend, config['repos'] is a SqliteRepos object reading
+    the database instead of the 'repos' of the file.  Callers that only read
+    the config pass read_only so that the database is not created. """
+    repo_file = get_repo_file(repo_file)
+    return _attach_backend(repo_file, _load_yaml(repo_file, create_missing), read_only)
+
+def get_backend(config):
+    backend = (config.get('config') or {}).get('backend') or 'yaml'
+    if backend not in BACKENDS:
+        raise RuntimeError(f"Unknown backend '{backend}' in config, must be one of {', '.join(BACKENDS)}")
+    return backend
+
+def get_database_file(repo_file, config):
+    """ The database of the SQLite backend, by default next to the config
+    file with the '.db' extension """
+    database = (config.get('config') or {}).get('database')
+    if database:
+        return os.path.expanduser(database)
+    return os.path.splitext(os.path.abspath(repo_file))[0] + '.db'
+
+def _attach_backend(repo_file, config, read_only=False):
+    if get_backend(config) == 'sqlite':
+        import _repos_sqlite
+        config['repos'] = _repos_sqlite.SqliteRepos(get_database_file(repo_file, config),
+                                                    yaml_repos=config['repos'], read_only=read_only)
+    return config
+
+def is_database(repos):
+    return hasattr(repos, 'yaml_repos')
+
+def get_database(repo_file, config):
+    """ The SQLite database of the config file even if the config does not
+    use the SQLite backend """
+    if is_database(config['repos']):
+        return config['repos']
+    import _repos_sqlite
+    return _repos_sqlite.SqliteRepos(get_database_file(repo_file, config))
+
+def yaml_config(config):
+    """ The part of config that is stored in the YAML file """
+    repos = config.get('repos')
+    if is_database(repos):
+        return {**config, 'repos': repos.yaml_repos}
+    return config
+
+def _update_index(repo_file, st, config, trusted=False):
+    data = _read_cache(repo_file, 'index')
+    index = RepoIndex(data['index'] if data else None)
+    index.update(config['repos'])
+    _write_cache(repo_file, 'index', st, index.paths, trusted=trusted, backend='yaml')
+    return index
+
+def make_index(repo_file, config):
+    """ Index of the repos of a config that was already loaded, like one
+    being modified in a transaction.  The saved index is reused so that only
+    the paths that changed are resolved. """
+    if is_database(config['repos']):
+        return config['repos']
+    data = _read_cache(repo_file, 'index')
+    index = RepoIndex(data['index'] if data else None)
+    index.update(config['repos'])
+    return index
+
+def get_index(repo_file=None):
+    """ Return the RepoIndex of the config file.  The config is only loaded
+    if the saved index is not up to date.  With the SQLite backend, the
+    database is the index, its file is saved with the index so that the
+    config is not needed to find it. """
+    repo_file = get_repo_file(repo_file)
+    st = os.stat(repo_file)
+    data = _read_cache(repo_file, 'index')
+    if data is not None and data['key'] == _cache_key(st):
+        if data.get('backend') == 'sqlite':
+            import _repos_sqlite
+            return _repos_sqlite.SqliteRepos(data['database'], read_only=True)
+        return RepoIndex(data['index'])
+    config = load(repo_file, read_only=True)
+    if is_database(config['repos']):
+        _write_cache(repo_file, 'index', st, None, backend='sqlite', database=config['repos'].filename)
+        return config['repos']
+    return _update_index(repo_file, st, config)
+
+def save(repo_file, config):
+    """ Write the config file atomically: the new content is written to a
+    temporary file in the same directory which is then renamed over the
+    config file so that readers see either the old or the new content and
+    never a truncated file.
+
+    Writes should be done through transaction() so that concurrent writers
+    don't lose each other's changes. """
+    repo_file = get_repo_file(repo_file)
+    # If the config file is a symlink (like into a dotfiles repo), replace
+    # the file it points to and not the link.
+    target = os.path.realpath(repo_file)
+    directory, basename = os.path.split(target)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=f".{basename}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w') as f:
+            dump(yaml_config(config), f)
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            os.chmod(tmp, os.stat(target).st_mode & 0o7777)
+        except FileNotFoundError:
+            os.chmod(tmp, 0o666 & ~_get_umask())
+        os.replace(tmp, target)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(tmp)
+        raise
+    return target
+
+def _get_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+@contextlib.contextmanager
+def lock(repo_file=None):
+    """ Hold an exclusive lock for modifying the config file.
+
+    The lock is taken on a separate '.lock' file because the config file
+    itself is replaced by a new file on each write. """
+    repo_file = get_repo_file(repo_file)
+    lock_file = f"{os.path.realpath(repo_file)}.lock"
+    with open(lock_file, 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+@contextlib.contextmanager
+def transaction(repo_file=None, create_missing=True):
+    """ Modify the config file under an exclusive lock
+
+        with _repos_config.transaction(repo_file) as config:
+            config['repos'][name] = {'path': path}
+
+    The config is loaded after the lock is acquired so that changes made by
+    other processes are not lost.  When the block finishes normally, the
+    config is written back atomically if it was modified.  If the block
+    raises an exception, nothing is written.
+
+    With the SQLite backend, the changes to config['repos'] are written to
+    the database in one SQLite transaction and the file is only written if
+    the rest of the config changed. """
+    repo_file = get_repo_file(repo_file)
+    if create_missing:
+        os.makedirs(os.path.dirname(os.path.abspath(repo_file)), exist_ok=True)
+    with lock(repo_file):
+        config = load(repo_file, create_missing=create_missing)
+        db = config['repos'] if is_database(config['repos']) else None
+        if db is not None:
+            db.begin()
+        before = pickle.dumps(yaml_config(config), protocol=pickle.HIGHEST_PROTOCOL)
+        try:
+            yield config
+        except BaseException:
+            if db is not None:
+                db.rollback()
+            raise
+        if db is not None:
+            db.commit()
+        stored = yaml_config(config)
+        if pickle.dumps(stored, protocol=pickle.HIGHEST_PROTOCOL) != before:
+            target = save(repo_file, stored)
+            # We hold the lock and all writers replace the file so nobody
+            # can have changed it without changing its inode: the caches
+            # can be written even if the file was modified very recently.
+            st = os.stat(target)
+            _write_cache(repo_file, 'config', st, stored, trusted=True)
+            if db is None:
+                _update_index(repo_file, st, stored, trusted=True)
@@ -0,0 +1,122 @@
+import os
+import collections
+import queue
+import threading
+import time
+
+import _repos_logging
+logger = _repos_logging.logger
+
+DEFAULT_JOBS = 8
+DEFAULT_TIMEOUT = 5.0
+
+PathInfo = collections.namedtuple('PathInfo', ['isdir', 'realpath'])
+
+def probe(path):
+    return PathInfo(os.path.isdir(path), os.path.realpath(path))
+
+def read_mount_points(mounts_file='/proc/self/mounts'):
+    """ Mount points from /proc/self/mounts, longest first.  Reading this file
+    never touches the mounted filesystems themselves. """
+    try:
+        with open(mounts_file) as f:
+            points = [l.split()[1].replace('\\040', ' ') for l in f if l.strip()]
+    except OSError:
+        return []
+    return sorted(set(points), key=len, reverse=True)
+
+class PathProber:
+    """ Check if paths are directories and get their real paths using a pool of
+    threads with a time limit for each path.
+
+    Paths on automounted network filesystems can block for a long time when
+    the server does not answer.  A path whose check takes longer than timeout
+    seconds is unknown and its result is None.  The thread doing it cannot be
+    interrupted so it is abandoned and replaced by a new one.  The mount point
+    of that path is then considered unresponsive and the other paths under it
+    are unknown without being checked.
+
+    Threads are daemon threads so that an abandoned check does not prevent
+    the program from exiting.
+    """
+    def __init__(self, jobs=DEFAULT_JOBS, timeout=DEFAULT_TIMEOUT):
+        self.jobs = max(1, jobs)
+        self.timeout = timeout
+        self.results = {}
+        self.dead_mounts = set()
+        self._mount_points = None
+        self._cond = threading.Condition()
+        self._queue = queue.Queue()
+        self._started = {}
+        self._abandoned = set()
+
+    def mount_point(self, path):
+        if self._mount_points is None:
+            self._mount_points = read_mount_points()
+        for m in self._mount_points:
+            if path == m or path.startswith(os.path.join(m, '')):
+                return m
+        return '/'
+
+    def _worker(self):
+        while True:
+            try:
+                path = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if self.mount_point(path) in self.dead_mounts:
+                info = None
+            else:
+                with self._cond:
+                    self._started[path] = time.monotonic()
+                info = probe(path)
+            with self._cond:
+                self._started.pop(path, None)
+                if path in self._abandoned:
+                    # We were replaced by another thread while we were stuck
+                    self._cond.notify_all()
+                    return
+                self.results[path] = info
+                self._cond.notify_all()
+
+    def _start_worker(self):
+        threading.Thread(target=self._worker, daemon=True).start()
+
+    def prefetch(self, paths):
+        """ Check all paths that have not been checked yet, return the time
+        it took and the number of unknown paths """
+        start = time.monotonic()
+        todo = {os.path.normpath(p) for p in paths} - self.results.keys()
+        for p in sorted(todo):
+            self._queue.put(p)
+        for _ in range(min(self.jobs, len(todo))):
+            self._start_worker()
+        unknown = 0
+        with self._cond:
+            while not todo <= self.results.keys():
+                now = time.monotonic()
+                for path, t in list(self._started.items()):
+                    if now - t < self.timeout:
+                        continue
+                    mount = self.mount_point(path)
+                    logger.warning(f"No answer after {self.timeout}s for '{path}', treating it as unknown")
+                    if mount != '/' and mount not in self.dead_mounts:
+                        logger.warning(f"Considering mount point '{mount}' as unresponsive")
+                        self.dead_mounts.add(mount)
+                    del self._started[path]
+                    self._abandoned.add(path)
+                    self.results[path] = None
+                    if not self._queue.empty():
+                        self._start_worker()
+                deadlines = [t + self.timeout for t in self._started.values()]
+                wait = min(deadlines) - now if deadlines else self.timeout
+                self._cond.wait(timeout=max(0.01, wait))
+            unknown = sum(1 for p in todo if self.results[p] is None)
+        return time.monotonic() - start, unknown
+
+    def info(self, path):
+        """ PathInfo for path or None if it could not be checked in time """
+        path = os.path.normpath(path)
+        if path not in self.results:
+            self.prefetch([path])
+        return self.results[path]
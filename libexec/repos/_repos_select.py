@@ -0,0 +1,88 @@
+import os
+import re
+import sys
+
+import _repos_base
+import _repos_config
+import _repos_logging
+logger = _repos_logging.logger
+
+def add_arguments(p):
+    """ Options to select the repos a tool works on """
+    p.add_argument("--name", help="Specify name for repo in config file.  Defaults to the repo containing PWD")
+    p.add_argument("--match", metavar='REGEX', help="Select all repos whose name matches REGEX")
+    p.add_argument("--under", metavar='PATH', help="Select all repos under PATH")
+    p.add_argument("--stdin", action='store_true', help="Select repos whose names or paths are read from stdin, one per line")
+    p.add_argument("--dry-run", action='store_true', help="List the selected repos and what would be done without modifying the config file")
+
+def check_arguments(p, args):
+    if args.match is not None:
+        try:
+            args.match = re.compile(args.match)
+        except re.error as e:
+            p.error(f"Invalid regular expression for --match: {e}")
+    if args.under is not None:
+        args.under = os.path.normpath(os.path.join(os.getcwd(), os.path.expanduser(args.under)))
+    if args.stdin:
+        args.stdin = [l.strip() for l in sys.stdin if l.strip()]
+
+def is_bulk(args):
+    return bool(args.match or args.under or args.stdin)
+
+def default_name(repo_file):
+    """ Name of the repo containing PWD.  If PWD is not under the path of any
+    repo, the repo root is looked up by its basename which finds a repo whose
+    path in the config is out of date. """
+    index = _repos_config.get_index(repo_file)
+    name = index.find_containing(os.getcwd())
+    if name is not None:
+        logger.info(f"Using name '{name}' of the repo containing PWD")
+        return name
+    repo_root = _repos_base.get_repo_root(os.getcwd())
+    if repo_root is None:
+        logger.error(f"No --name provided and could not find repo root starting at PWD")
+        return None
+    names = index.find_by_basename(os.path.basename(os.path.realpath(repo_root)))
+    if len(names) == 1:
+        logger.info(f"Using name '{names[0]}' of the repo with the same basename as REPO_ROOT")
+        return names[0]
+    if len(names) > 1:
+        logger.error(f"No --name provided and several repos have the basename of REPO_ROOT: {', '.join(names)}")
+        return None
+    logger.info(f"Using basename(REPO_ROOT): '{repo_root.name}' as repo name")
+    return os.path.basename(repo_root.name)
+
+def _is_under(path, directories):
+    path = os.path.normpath(os.path.expanduser(path))
+    return any(path == d or path.startswith(os.path.join(d, '')) for d in directories)
+
+def select(args, repo_file, config):
+    """ Sorted names of the repos selected by the options added by
+    add_arguments().  Repos given with --name or --stdin are then filtered by
+    --match and --under, otherwise these filter all the repos.  Returns None
+    after logging an error if a repo given by name or path is not found. """
+    repos = config['repos']
+    if args.name is not None or args.stdin:
+        index = _repos_config.make_index(repo_file, config)
+        names = []
+        for item in ([args.name] if args.name is not None else []) + (args.stdin or []):
+            if item in repos:
+                names.append(item)
+                continue
+            name = index.find_by_path(item)
+            if name is None:
+                logger.error(f"No repo with name or path '{item}' in repo file '{repo_file}'")
+                return None
+            names.append(name)
+        candidates = [(n, repos[n]) for n in sorted(set(names))]
+    else:
+        candidates = sorted(repos.items())
+
+    if args.match is not None:
+        candidates = [(n, r) for n, r in candidates if args.match.search(n)]
+    if args.under is not None:
+        # Compare with the real path of the directory too but not with the
+        # real paths of all repos which would mean a stat for each of them
+        directories = {args.under, os.path.realpath(args.under)}
+        candidates = [(n, r) for n, r in candidates if _is_under(r['path'], directories)]
+    return [n for n, _ in candidates]
@@ -0,0 +1,223 @@
+import os
+import collections.abc
+import json
+import sqlite3
+import urllib.parse
+
+import _repos_logging
+logger = _repos_logging.logger
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS repos (
+    name TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    realpath TEXT NOT NULL,
+    basename TEXT NOT NULL,
+    comment TEXT,
+    ignore INTEGER,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS repos_path ON repos(path);
+CREATE INDEX IF NOT EXISTS repos_realpath ON repos(realpath);
+CREATE INDEX IF NOT EXISTS repos_basename ON repos(basename);
+"""
+
+def _row_to_repo(path, comment, ignore, extra):
+    repo = json.loads(extra) if extra else {}
+    repo['path'] = path
+    if comment is not None:
+        repo['comment'] = comment
+    if ignore is not None:
+        repo['ignore'] = bool(ignore)
+    return repo
+
+def _repo_to_row(name, repo):
+    extra = {k: v for k, v in repo.items() if k not in ('path', 'comment', 'ignore')}
+    path = os.path.expanduser(str(repo['path']))
+    real = os.path.realpath(path)
+    ignore = repo.get('ignore')
+    return (name, repo['path'], real, os.path.basename(real), repo.get('comment'),
+            None if ignore is None else int(bool(ignore)),
+            json.dumps(extra, sort_keys=True) if extra else None)
+
+def _snapshot(repo):
+    return json.dumps(repo, sort_keys=True, default=str)
+
+class SqliteRepos(collections.abc.MutableMapping):
+    """ The 'repos' section of the config file stored in an SQLite database.
+
+    This behaves like the dictionary of the YAML file so that the tools can
+    use either backend without knowing which one they have.  The dictionaries
+    returned for each repo can be modified in place: they are remembered and
+    the ones that changed are written back by commit().
+
+    Lookups by name and by path use the indexes of the database so a tool that
+    works on one repo does not need to read all of them.
+
+    The 'repos' of the YAML file are kept in yaml_repos so that writing the
+    rest of the config file does not lose them.
+
+    With read_only, the database is opened without creating it or changing
+    it, a database that doesn't exist is seen as empty.
+    """
+    def __init__(self, filename, yaml_repos=None, read_only=False):
+        self.filename = filename
+        self.yaml_repos = yaml_repos if yaml_repos is not None else {}
+        if read_only and not os.path.exists(filename):
+            self.db = sqlite3.connect(":memory:", isolation_level=None)
+            self.db.executescript(SCHEMA)
+        elif read_only:
+            uri = f"file:{urllib.parse.quote(os.path.abspath(filename))}?mode=ro"
+            self.db = sqlite3.connect(uri, uri=True, timeout=60, isolation_level=None)
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+            self.db = sqlite3.connect(filename, timeout=60, isolation_level=None)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.executescript(SCHEMA)
+        self._loaded = {}
+        self._set = {}
+        self._deleted = set()
+
+    #
+    # Transactions
+    #
+    def begin(self):
+        """ Take the write lock of the database so that the changes made
+        until commit() are based on an up to date state """
+        self.db.execute("BEGIN IMMEDIATE")
+
+    def commit(self):
+        rows = []
+        for name, (repo, snapshot) in self._loaded.items():
+            if name not in self._deleted and name not in self._set and _snapshot(repo) != snapshot:
+                rows.append(_repo_to_row(name, repo))
+        rows += [_repo_to_row(name, repo) for name, repo in self._set.items()]
+        if not self.db.in_transaction:
+            self.db.execute("BEGIN IMMEDIATE")
+        self.db.executemany("DELETE FROM repos WHERE name = ?", [(n,) for n in self._deleted])
+        self.db.executemany("INSERT OR REPLACE INTO repos VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        self.db.execute("COMMIT")
+        self._loaded = {}
+        self._set = {}
+        self._deleted = set()
+
+    def rollback(self):
+        if self.db.in_transaction:
+            self.db.execute("ROLLBACK")
+        self._loaded = {}
+        self._set = {}
+        self._deleted = set()
+
+    def close(self):
+        self.db.close()
+
+    #
+    # Mapping interface
+    #
+    def _remember(self, name, repo):
+        self._loaded[name] = (repo, _snapshot(repo))
+        return repo
+
+    def __getitem__(self, name):
+        if name in self._deleted:
+            raise KeyError(name)
+        if name in self._set:
+            return self._set[name]
+        if name in self._loaded:
+            return self._loaded[name][0]
+        row = self.db.execute("SELECT path, comment, ignore, extra FROM repos WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            raise KeyError(name)
+        return self._remember(name, _row_to_repo(*row))
+
+    def __setitem__(self, name, repo):
+        self._deleted.discard(name)
+        self._loaded.pop(name, None)
+        self._set[name] = repo
+
+    def __delitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        self._set.pop(name, None)
+        self._loaded.pop(name, None)
+        self._deleted.add(name)
+
+    def __contains__(self, name):
+        if name in self._deleted:
+            return False
+        if name in self._set:
+            return True
+        return self.db.execute("SELECT 1 FROM repos WHERE name = ?", (name,)).fetchone() is not None
+
+    def __iter__(self):
+        names = [n for (n,) in self.db.execute("SELECT name FROM repos ORDER BY name")]
+        seen = set(names)
+        names += [n for n in self._set if n not in seen]
+        return iter([n for n in names if n not in self._deleted])
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def items(self):
+        """ All repos with one query instead of one per repo """
+        result = []
+        for name, path, comment, ignore, extra in self.db.execute(
+                "SELECT name, path, comment, ignore, extra FROM repos ORDER BY name"):
+            if name in self._deleted or name in self._set:
+                continue
+            if name in self._loaded:
+                result.append((name, self._loaded[name][0]))
+            else:
+                result.append((name, self._remember(name, _row_to_repo(path, comment, ignore, extra))))
+        result += list(self._set.items())
+        return result
+
+    def values(self):
+        return [repo for _, repo in self.items()]
+
+    def to_dict(self):
+        return {name: dict(repo) for name, repo in self.items()}
+
+    def replace_all(self, repos):
+        """ Make the database contain exactly repos """
+        for name in list(self):
+            if name not in repos:
+                del self[name]
+        for name, repo in repos.items():
+            self[name] = repo
+
+    #
+    # Same lookups as _repos_config.RepoIndex
+    #
+    def find_by_path(self, path):
+        path = os.path.abspath(os.path.expanduser(path))
+        for p in (path, os.path.realpath(path)):
+            row = self.db.execute("SELECT name FROM repos WHERE path = ? OR realpath = ? ORDER BY name LIMIT 1", (p, p)).fetchone()
+            if row is not None:
+                return row[0]
+        return None
+
+    def find_containing(self, path):
+        path = os.path.abspath(os.path.expanduser(path))
+        for p in (path, os.path.realpath(path)):
+            candidates = []
+            while True:
+                candidates.append(p)
+                parent = os.path.dirname(p)
+                if parent == p:
+                    break
+                p = parent
+            marks = ','.join('?' * len(candidates))
+            rows = self.db.execute(f"SELECT name, path, realpath FROM repos WHERE path IN ({marks}) OR realpath IN ({marks})",
+                                   candidates + candidates).fetchall()
+            if rows:
+                # Innermost repo: the one matching the longest candidate
+                def depth(row):
+                    return max(len(row[1]) if row[1] in candidates else 0,
+                               len(row[2]) if row[2] in candidates else 0)
+                return sorted(rows, key=lambda r: (-depth(r), r[0]))[0][0]
+        return None
+
+    def find_by_basename(self, basename):
+        return [n for (n,) in self.db.execute("SELECT name FROM repos WHERE basename = ? ORDER BY name", (basename,))]
@@ -0,0 +1,207 @@
+import os
+import concurrent.futures
+import subprocess
+import time
+
+import _repos_logging
+logger = _repos_logging.logger
+
+DEFAULT_JOBS = 20
+
+#
+# Compute the state of repos in the same format as the JSON output of the Go
+# 'repos' program ('repos -output-format json -branch') without starting it.
+#
+# Most of the state comes from a single 'git status --porcelain=v2 --branch'
+# which gives the branch, the ahead/behind counts and the changed and
+# untracked files.  The only other commands run for every repo are the one
+# for the time of the last commit and 'git fetch' unless fetching is
+# disabled.  Line counts of changes require 'git diff --numstat' which is
+# only run for repos that have changes.
+#
+# The state also has 'LastCommitTime', the time of the last commit in seconds
+# since the epoch, which unlike 'TimeSinceLastCommit' doesn't change each
+# time the state is computed.
+#
+
+class GitError(Exception):
+    pass
+
+# Function called with the git subcommand, exit code and duration of each git
+# process, for programs that collect metrics
+_observer = None
+
+def set_process_observer(observer):
+    global _observer
+    _observer = observer
+
+def git(path, *args, check=True):
+    """ Run git in path and return its output """
+    start = time.monotonic()
+    result = subprocess.run(["git", "--no-optional-locks", *args], cwd=path,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if _observer is not None:
+        _observer(args[0], result.returncode, time.monotonic() - start)
+    if check and result.returncode != 0:
+        raise GitError(f"'git {' '.join(args)}' failed in '{path}': {result.stderr.decode(errors='replace').strip()}")
+    return result.stdout
+
+def repo_config(name, repo):
+    """ The 'Config' part of the status of a repo """
+    return {
+        'Path': repo.get('path', ''),
+        'Name': name,
+        'ShortName': repo.get('shortname') or '',
+        'Fetch': bool(repo.get('fetch')),
+        'Comment': repo.get('comment') or '',
+        'Remote': repo.get('remote') or '',
+        'Ignore': bool(repo.get('ignore')),
+    }
+
+def empty_state():
+    return {
+        'Dirty': False,
+        'UntrackedFiles': 0,
+        'UntrackedDirs': 0,
+        'TimeSinceLastCommit': 0,
+        'LastCommitTime': 0,
+        'RemoteState': {'Ahead': 0, 'Behind': 0},
+        'StagedChanges': False,
+        'Files': 0,
+        'Insertions': 0,
+        'Deletions': 0,
+        'StagedInsertions': 0,
+        'StagedDeletions': 0,
+        'StagedFiles': 0,
+        'CurrentBranch': '',
+    }
+
+def parse_porcelain_v2(data):
+    """ Parse the output of 'git status --porcelain=v2 --branch -z' """
+    result = {'oid': None, 'head': None, 'upstream': None, 'ahead': 0, 'behind': 0,
+              'staged': 0, 'unstaged': 0, 'untracked_files': 0, 'untracked_dirs': 0}
+    entries = data.split(b'\0')
+    i = 0
+    while i < len(entries):
+        entry = entries[i].decode(errors='surrogateescape')
+        i += 1
+        if not entry:
+            continue
+        kind = entry[0]
+        if kind == '#':
+            _, key, *values = entry.split(' ')
+            if key == 'branch.oid':
+                result['oid'] = values[0]
+            elif key == 'branch.head':
+                result['head'] = values[0]
+            elif key == 'branch.upstream':
+                result['upstream'] = values[0]
+            elif key == 'branch.ab':
+                result['ahead'] = int(values[0])
+                result['behind'] = -int(values[1])
+        elif kind in '12u':
+            xy = entry[2:4]
+            if xy[0] != '.':
+                result['staged'] += 1
+            if xy[1] != '.':
+                result['unstaged'] += 1
+            if kind == '2':
+                # Renames and copies are followed by the original path
+                i += 1
+        elif kind == '?':
+            if entry.endswith('/'):
+                result['untracked_dirs'] += 1
+            else:
+                result['untracked_files'] += 1
+    return result
+
+def numstat(path, staged):
+    """ Number of files, insertions and deletions of the unstaged or staged
+    changes, counting 1 insertion and deletion for binary files like the Go
+    program """
+    args = ["diff", "--no-ext-diff", "--numstat"] + (["--staged"] if staged else [])
+    files = insertions = deletions = 0
+    for line in git(path, *args).decode(errors='replace').splitlines():
+        words = line.split('\t')
+        if len(words) < 3:
+            continue
+        insertions += 1 if words[0] == '-' else int(words[0])
+        deletions += 1 if words[1] == '-' else int(words[1])
+        files += 1
+    return files, insertions, deletions
+
+class StateError(Exception):
+    """ Raised when the state of a repo could not be completely computed,
+    state is what could be computed with a remote state of -1, -1 like the
+    Go program """
+    def __init__(self, message, state):
+        super().__init__(message)
+        self.state = state
+
+def get_state(path, fetch=True, branch=True):
+    """ The 'State' part of the status of the repo at path """
+    state = empty_state()
+    try:
+        _fill_state(state, path, fetch, branch)
+    except (GitError, OSError, ValueError) as e:
+        state['RemoteState'] = {'Ahead': -1, 'Behind': -1}
+        raise StateError(str(e), state) from e
+    return state
+
+def _fill_state(state, path, fetch, branch):
+    out = git(path, "log", "--pretty=format:%at", "-1").strip()
+    state['LastCommitTime'] = int(out or 0)
+    state['TimeSinceLastCommit'] = int((time.time() - state['LastCommitTime']) * 1_000_000_000)
+
+    fetch_error = None
+    if fetch:
+        try:
+            git(path, "fetch", "--quiet")
+        except GitError as e:
+            fetch_error = e
+
+    status = parse_porcelain_v2(git(path, "status", "--porcelain=v2", "--branch", "-z"))
+    if status['unstaged']:
+        state['Files'], state['Insertions'], state['Deletions'] = numstat(path, staged=False)
+    state['Dirty'] = state['Insertions'] > 0 or state['Deletions'] > 0
+    if status['staged']:
+        state['StagedFiles'], state['StagedInsertions'], state['StagedDeletions'] = numstat(path, staged=True)
+    state['StagedChanges'] = state['StagedInsertions'] > 0 or state['StagedDeletions'] > 0
+    state['UntrackedFiles'] = status['untracked_files']
+    state['UntrackedDirs'] = status['untracked_dirs']
+    if branch:
+        if status['head'] and status['head'] != '(detached)':
+            state['CurrentBranch'] = status['head']
+        elif status['oid'] and status['oid'] != '(initial)':
+            state['CurrentBranch'] = f"(({status['oid'][:7]}))"
+    if fetch_error is not None:
+        raise fetch_error
+    state['RemoteState'] = {'Ahead': status['ahead'], 'Behind': status['behind']}
+
+def repo_status(name, repo, fetch=True, branch=True):
+    """ Status of a repo in the format of one element of the array output
+    by 'repos -output-format json'.  Like the Go program, a repo on which git
+    commands fail is still returned, with a remote state of -1, -1. """
+    path = os.path.expanduser(repo.get('path', ''))
+    try:
+        state = get_state(path, fetch=fetch, branch=branch)
+    except StateError as e:
+        logger.warning(f"Repo '{name}': {e}")
+        state = e.state
+    return {'Config': repo_config(name, repo), 'State': state}
+
+def statuses(repos, jobs=DEFAULT_JOBS, fetch=True, branch=True, executor=None):
+    """ Yield the status of each of the (name, repo) pairs of repos in the
+    order in which they are computed, at most jobs at a time """
+    own = executor is None
+    if own:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="repos-status")
+    futures = [executor.submit(repo_status, name, repo, fetch, branch) for name, repo in repos]
+    try:
+        for future in concurrent.futures.as_completed(futures):
+            yield future.result()
+    finally:
+        for future in futures:
+            future.cancel()
+        if own:
+            executor.shutdown(wait=False)
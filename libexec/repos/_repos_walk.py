@@ -0,0 +1,298 @@
+import os
+import collections
+import concurrent.futures
+import fnmatch
+import pickle
+import re
+import threading
+import time
+
+import _repos_base
+import _repos_logging
+logger = _repos_logging.logger
+
+DEFAULT_JOBS = 8
+
+# subdirs are the names that were listed and listed_at the time of the
+# listing, only needed to list the directory again after on_dir()
+ScanResult = collections.namedtuple('ScanResult', ['path', 'depth', 'is_repo', 'children', 'subdirs', 'listed_at'],
+                                    defaults=[(), None])
+
+class ScanCache:
+    """ Persistent record of directory listings from previous scans.
+
+    For each directory, we keep its mtime, whether it is a git repo and the
+    names of its subdirectories.  Creating, deleting or renaming an entry
+    changes the mtime of the directory containing it so a directory whose
+    mtime has not changed does not need to be listed again.
+
+    The mtime is checked every time an entry is used so stale entries are
+    never trusted, they only take up space.  They are dropped when a recursive
+    scan covers the directory they are in.
+    """
+    VERSION = 2
+    # Directories modified this recently are not cached because a change
+    # made in the same timestamp tick would go unnoticed next time.
+    RACY_NS = 2 * 10**9
+
+    def __init__(self, filename, rebuild=False):
+        self.filename = filename
+        self.entries = {}
+        self.seen = {}
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if not rebuild:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.filename, 'rb') as f:
+                data = pickle.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable scan cache '{self.filename}': {e}")
+            return
+        if not isinstance(data, dict) or data.get('version') != self.VERSION:
+            logger.info(f"Scan cache '{self.filename}' is from another version, rebuilding it")
+            return
+        self.entries = data['entries']
+
+    def get(self, path, mtime):
+        entry = self.entries.get(path)
+        with self._lock:
+            if entry is not None and entry[0] == mtime:
+                self.hits += 1
+                self.seen[path] = entry
+                return entry[1], entry[2]
+            self.misses += 1
+        return None
+
+    def put(self, path, mtime, is_repo, subdirs):
+        if time.time_ns() - mtime < self.RACY_NS:
+            return
+        self.seen[path] = (mtime, is_repo, tuple(subdirs))
+
+    def save(self, complete_roots=()):
+        """ Write the cache, forgetting directories under complete_roots that
+        were not seen during this scan """
+        prefixes = [os.path.join(r, '') for r in complete_roots]
+        entries = {
+            p: e for p, e in self.entries.items()
+            if not any(p == r or p.startswith(prefix) for r, prefix in zip(complete_roots, prefixes))
+        }
+        entries.update(self.seen)
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        tmp = f"{self.filename}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            pickle.dump({'version': self.VERSION, 'entries': entries}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.filename)
+        self.entries = entries
+        self.seen = {}
+
+class Pruner:
+    """ Decide which directories the walker should not go into.
+
+    Prune rules are globs matched against the basename of directories, or
+    against their full path if the rule contains a '/'.  Rules starting with
+    're:' are regular expressions searched in the basename (or in the full
+    path if they contain a '/').  All the rules are compiled into one regular
+    expression for basenames and one for paths so that checking a directory
+    is a single match no matter how many rules there are.
+
+    The --include and --exclude regular expressions keep their meaning: a
+    directory is searched if it doesn't match EXCLUDE or if it matches
+    INCLUDE.  Prune rules win over --include.
+    """
+    def __init__(self, rules=(), include=None, exclude=None):
+        self.rules = list(rules)
+        self.include = include
+        self.exclude = exclude
+        name_patterns = []
+        path_patterns = []
+        for rule in self.rules:
+            if rule.startswith('re:'):
+                pattern = f"(?:{rule[3:]})"
+            else:
+                pattern = f"^{fnmatch.translate(rule)}"
+            if '/' in rule:
+                path_patterns.append(pattern)
+            else:
+                name_patterns.append(pattern)
+        self.name_re = re.compile('|'.join(name_patterns)) if name_patterns else None
+        self.path_re = re.compile('|'.join(path_patterns)) if path_patterns else None
+
+    def prune(self, name, path):
+        return bool((self.name_re and self.name_re.search(name))
+                    or (self.path_re and self.path_re.search(path)))
+
+    def keep(self, name, path):
+        if name.startswith('.'):
+            return False
+        if self.prune(name, path):
+            return False
+        if self.include and self.exclude:
+            return (not self.exclude.search(name)) or bool(self.include.search(name))
+        elif self.include:
+            return bool(self.include.search(name))
+        elif self.exclude:
+            return not self.exclude.search(name)
+        return True
+
+class Walker:
+    """ Find git repositories under directories using a pool of threads.
+
+    Each directory is checked for being a repo with a few stats and if it is
+    not, it is listed once with os.scandir() by a worker thread and its
+    subdirectories are submitted to the pool right away so that workers never
+    wait on each other.  Repos are never listed and the type information of
+    the DirEntry objects is used instead of doing one stat per entry.
+
+    Results are consumed in depth-first order with entries sorted by name so
+    the output does not depend on which worker finishes first.
+
+    The directories given to walk() are at depth 0 and their subdirectories
+    are only looked into if max_depth allows it.  With max_depth=1, only the
+    direct subdirectories are checked for being repos.
+    """
+    def __init__(self, pruner=None, max_depth=None, jobs=DEFAULT_JOBS, cache=None, on_dir=None):
+        self.pruner = pruner if pruner is not None else Pruner()
+        self.max_depth = max_depth
+        self.jobs = max(1, jobs)
+        self.cache = cache
+        # Called as on_dir(path, depth) from the thread consuming walk() for
+        # every directory that was looked into and is not a repo.  If the
+        # directory may have changed since it was listed, it is listed again
+        # after the call so that a watch set by on_dir() misses nothing.
+        self.on_dir = on_dir
+        self.stats = collections.Counter()
+        self._stats_lock = threading.Lock()
+        self._pool = None
+        self._stop = threading.Event()
+
+    def count(self, key, n=1):
+        with self._stats_lock:
+            self.stats[key] += n
+
+    def walk(self, root, depth=0):
+        """ Yield (name, {'path': path}) for each git repo in root or root
+        itself if it is a git repo.  The depth argument is the depth of root
+        with respect to max_depth. """
+        root = os.path.normpath(root)
+        self._stop.clear()
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs)
+        try:
+            stack = [iter([self._submit(root, depth)])]
+            while stack:
+                future = next(stack[-1], None)
+                if future is None:
+                    stack.pop()
+                    continue
+                result = future.result()
+                if result.is_repo:
+                    name = os.path.basename(result.path)
+                    logger.debug(f"Yielding ({name}, {{'path': '{result.path}'}})")
+                    yield (name, {'path': result.path})
+                    continue
+                if self.on_dir is not None:
+                    self.on_dir(result.path, result.depth)
+                    late = self._relist(result)
+                    if late is True:
+                        name = os.path.basename(result.path)
+                        yield (name, {'path': result.path})
+                        continue
+                    if late:
+                        stack.append(iter(late))
+                if result.children:
+                    stack.append(iter(result.children))
+        finally:
+            # Tasks still in the queue return immediately once _stop is set
+            # which happens when the generator is closed early or when the
+            # user does Ctrl-C.
+            self._stop.set()
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+    def _submit(self, path, depth):
+        return self._pool.submit(self._scan, path, depth)
+
+    def _list(self, path):
+        """ Return (is_repo, subdirs) for path, using the cache if possible """
+        mtime = None
+        if self.cache is not None:
+            mtime = os.stat(path).st_mtime_ns
+            cached = self.cache.get(path, mtime)
+            if cached is not None:
+                return cached
+
+        is_repo, subdirs = _repos_base.is_git_repo(path), []
+        if not is_repo:
+            with os.scandir(path) as it:
+                for e in it:
+                    if e.name.startswith('.'):
+                        continue
+                    try:
+                        if e.is_dir():
+                            subdirs.append(e.name)
+                    except OSError:
+                        continue
+            subdirs.sort()
+
+        if self.cache is not None:
+            self.cache.put(path, mtime, is_repo, subdirs)
+        return is_repo, subdirs
+
+    def _relist(self, result):
+        """ List the directory of result again if it changed since it was
+        listed or if it was modified too recently before the listing for a
+        change to be seen in its mtime.  Return True if it became a repo or
+        the futures of the subdirectories that were not listed before. """
+        try:
+            mtime = os.stat(result.path).st_mtime_ns
+        except OSError:
+            return []
+        if mtime < result.listed_at - ScanCache.RACY_NS:
+            return []
+        try:
+            is_repo, subdirs = self._list(result.path)
+        except OSError:
+            return []
+        if is_repo:
+            return True
+        self.count('relisted')
+        known = set(result.subdirs)
+        return self._children(result.path, result.depth, [n for n in subdirs if n not in known])
+
+    def _children(self, path, depth, subdirs):
+        children = []
+        if self.max_depth is not None and depth >= self.max_depth:
+            self.count('depth-limited', len(subdirs))
+            return children
+        for name in subdirs:
+            child = os.path.join(path, name)
+            if self.pruner.keep(name, child):
+                children.append(self._submit(child, depth + 1))
+            else:
+                self.count('pruned')
+        return children
+
+    def _scan(self, path, depth):
+        if self._stop.is_set():
+            return ScanResult(path, depth, False, [])
+        logger.debug(f"Doing directory {path}")
+        listed_at = time.time_ns()
+        try:
+            is_repo, subdirs = self._list(path)
+        except (PermissionError, NotADirectoryError):
+            return ScanResult(path, depth, False, [])
+        except FileNotFoundError as e:
+            logger.warning(f"FileNotFoundError: {e}")
+            return ScanResult(path, depth, False, [])
+
+        self.count('visited')
+        if is_repo:
+            self.count('repos')
+            return ScanResult(path, depth, True, [])
+
+        return ScanResult(path, depth, False, self._children(path, depth, subdirs), subdirs, listed_at)
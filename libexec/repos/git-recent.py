@@ -1,23 +1,47 @@
 #!/usr/bin/env python3
 import os
 import sys
+import concurrent.futures
+import contextlib
 import datetime
+import hashlib
+import json
+import pickle
 import subprocess
+import tempfile
 from pprint import pprint
 import argparse
 
+import _repos_base
+import _repos_config
+import _repos_logging
+import _repos_status
+logger = _repos_logging.logger
+
 def arg_parser():
     p = argparse.ArgumentParser(description="Print today and yesterday's commits for a git repo")
     p.add_argument("--days", "-d", default=1, help="Number of days to go before yesterday")
     p.add_argument("--all", "-a", action='store_true', help="Check recent commits for all branches")
+    p.add_argument("--fleet", action='store_true', help="Show the recent commits of all the repos of the config file that are not ignored in a single timeline")
+    p.add_argument("-F", help="Specify alternate file to ~/.config/repos.yml, implies --fleet")
+    p.add_argument("--jobs", "-j", type=int, default=_repos_status.DEFAULT_JOBS, help="Number of repos looked at the same time with --fleet")
+    p.add_argument("--format", choices=['text', 'json'], default='text', help="Output format")
+    p.add_argument("--no-cache", action='store_true', help="Don't use the commit cache in ~/.cache/repos")
+    p.add_argument("--rebuild-cache", action='store_true', help="Discard the commit cache of the repos and rebuild it")
     return p
 
 def main():
     args = arg_parser().parse_args()
+    if args.F:
+        args.fleet = True
+    if args.fleet:
+        return fleet_recent(args)
     repo_dir = os.getcwd()
-    repo = Repo(repo_dir)
+    repo = Repo(repo_dir, get_cache(repo_dir, args))
     try:
-        if args.all:
+        if args.format == 'json':
+            print_json(repo.commits_since(window_start(int(args.days)), all_branches=args.all))
+        elif args.all:
             repo.all_recent(days=int(args.days))
         else:
             repo.print_recent_commits(days=int(args.days))
@@ -25,103 +49,315 @@ def main():
         print(e.cmd, e.args, e.stderr.strip())
         return 1
 
-class Repo:
-    def __init__(self, repo_dir):
-        self.repo_dir = repo_dir
+def get_cache(repo_dir, args):
+    """ The commit cache of the repo at repo_dir, only in memory with
+    --no-cache.  It is keyed on the git directory so that it is the same
+    from any subdirectory of the working tree. """
+    if args.no_cache:
+        return CommitCache()
+    result = subprocess.run(["git", "rev-parse", "--absolute-git-dir"], cwd=repo_dir,
+                            universal_newlines=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    git_dir = result.stdout.strip() if result.returncode == 0 else repo_dir
+    h = hashlib.sha1(os.path.realpath(git_dir).encode()).hexdigest()[:16]
+    return CommitCache(os.path.join(_repos_base.get_cache_dir(), f"recent-{h}.pickle"), rebuild=args.rebuild_cache)
 
-    def branches(self):
-        cmd = f"git branch --format='%(refname:short)'"
-        result = subprocess.run(cmd,
-                cwd=self.repo_dir,
-                shell=True, universal_newlines=True, check=True, stdout=subprocess.PIPE)
-        for l in result.stdout.splitlines():
-            if 'HEAD' in l:
+def list_commits(repo_dir, begin, args):
+    return list(Repo(repo_dir, get_cache(repo_dir, args)).commits_since(begin, all_branches=args.all))
+
+def fleet_recent(args):
+    """ Recent commits of all the repos of the config file that are not
+    ignored, collected in a pool of threads and printed as one timeline """
+    repo_file = _repos_config.get_repo_file(args.F)
+    repos = [(name, repo) for name, repo in _repos_config.load(repo_file, read_only=True)['repos'].items()
+             if not repo.get('ignore')]
+    days = int(args.days)
+    begin = window_start(days)
+    commits = []
+    failed = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {executor.submit(list_commits, os.path.expanduser(repo['path']), begin, args): name
+                   for name, repo in repos}
+        for future in concurrent.futures.as_completed(futures):
+            name = futures[future]
+            try:
+                repo_commits = future.result()
+            except subprocess.CalledProcessError as e:
+                logger.warning(f"Repo '{name}': {e.stderr.strip()}")
+                failed += 1
                 continue
-            if '(' in l:
+            except (OSError, RuntimeError) as e:
+                logger.warning(f"Repo '{name}': {e}")
+                failed += 1
                 continue
-            yield l
+            for c in repo_commits:
+                c['repo'] = name
+            commits += repo_commits
 
-    def commits_between_dates(self, begin, end, branch="HEAD"):
-        """ Yield recent commits reacheable from a certain branch made up to 'days'
-        days in the past.
+    commits.sort(key=lambda c: (c['committed'], c['repo']), reverse=True)
+    if args.format == 'json':
+        print_json(commits)
+    else:
+        today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+        today_commits = [c for c in commits if c['committed'] >= today]
+        past_commits = [c for c in commits if c['committed'] < today]
+        if today_commits:
+            print(f"\033[1;37mToday's commits in {len(repos)} repos\033[0m")
+            print_list(today_commits, show_branch=args.all)
+        if past_commits:
+            if days == 1:
+                print(f'\033[1;37mCommits made yesterday in {len(repos)} repos\033[0m')
+            else:
+                print(f'\033[1;37mCommits made between yesterday and {days} days ago in {len(repos)} repos\033[0m')
+            print_list(past_commits, show_branch=args.all)
+    return 1 if failed else 0
 
-        YIELDS: Dictionnaries of the form
+class CommitCache:
+    """ Persistent record of the commits of a repo made since some time with
+    the tips of the local branches and HEAD when they were walked.
 
-            {
-                'commit': <HASH>,
-                'date': <DATETIME OBJECT>,
-                'message': <MESSAGE>
-            }
+    Each commit is stored with its parents so that the branches from which
+    it is reachable can be computed again when tips move.  Only commits
+    added since the cached tips need to be walked: 'git log NEW_TIPS --not
+    OLD_TIPS'.  Commits that are no longer reachable from any tip, like
+    after a rebase or a forced update, are dropped.  If an old tip no longer
+    exists, everything is walked again. """
+    VERSION = 1
+    # Commits older than the oldest requested window by more than this are
+    # forgotten so that the cache doesn't grow forever
+    KEEP = 30 * 24 * 3600
 
-        use commit_list = list(gen_recent_commits(...)) to get a printable list.
+    def __init__(self, filename=None, rebuild=False):
+        self.filename = filename
+        self.since = None
+        self.tips = {}
+        self.commits = {}
+        self.modified = False
+        if filename is not None and not rebuild:
+            self.load()
 
-        Implementation details:
+    def load(self):
+        try:
+            with open(self.filename, 'rb') as f:
+                data = pickle.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable commit cache '{self.filename}': {e}")
+            return
+        if not isinstance(data, dict) or data.get('version') != self.VERSION:
+            return
+        self.since = data['since']
+        self.tips = data['tips']
+        self.commits = data['commits']
 
-        We use 'git log {branch} --after={date} --pretty=format:{format} where date is
-        today's date minus the prescribed number of days and {format} makes the
-        output easy to parse.
+    def save(self):
+        if self.filename is None or not self.modified:
+            return
+        # Threads of --fleet can save the same cache when a repo is listed
+        # twice so the temporary file must be unique to each of them.
+        directory, basename = os.path.split(self.filename)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=f".{basename}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump({'version': self.VERSION, 'since': self.since, 'tips': self.tips,
+                             'commits': self.commits}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.filename)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp)
+            raise
+        self.modified = False
 
-        """
-        # This format '%h %at %ae %an\n%s' allows me to parse the output in pairs
-        # of lines to deal with fields that can contain spaces by putting them
-        # at the end of the line or on its own line.
-        #
-        # This relies getting exactly two lines per commit which is dependant
-        # on the fields not having any newline characters inside them.  The
-        # only one where that could potentially happen is the author name since
-        # '%s' is by definition a single line.
-        #
-        # Even if I configure an author name that contains newlines, the output
-        # of git log does not print these newlines therefore we can safely rely
-        # on this method to produce exactly two lines per commit.
-        start_date = begin.strftime("%Y-%m-%d %H:%M")
-        end_date = end.strftime("%Y-%m-%d %H:%M")
-        cmd = f'git log --after="{start_date}" --before="{end_date}" --pretty=format:"%h %at %ae %an\n%s" {branch}'
-        result = subprocess.run(
-            cmd,
-            shell=True,
+    def reset(self, since):
+        self.since = since
+        self.tips = {}
+        self.commits = {}
+        self.modified = True
+
+    def prune(self, since):
+        """ Forget commits made long before since """
+        if self.since < since - self.KEEP:
+            self.since = since - self.KEEP
+            self.commits = {h: c for h, c in self.commits.items() if c['committed'] >= self.since}
+            self.modified = True
+
+    def label(self):
+        """ Compute the branches from which each commit is reachable and drop
+        the commits that are not reachable from any """
+        branches = {h: [] for h in self.commits}
+        for name, tip in sorted(self.tips.items()):
+            stack = [tip]
+            seen = set()
+            while stack:
+                h = stack.pop()
+                if h in seen or h not in self.commits:
+                    continue
+                seen.add(h)
+                branches[h].append(name)
+                stack.extend(self.commits[h]['parents'])
+        self.commits = {h: dict(c, branches=tuple(branches[h])) for h, c in self.commits.items() if branches[h]}
+
+class Repo:
+    # Fields of a commit separated by the unit separator character, commits
+    # are separated by NUL with -z so that no field can break the parsing.
+    FORMAT = "%H%x1f%P%x1f%ct%x1f%at%x1f%ae%x1f%an%x1f%s"
+
+    def __init__(self, repo_dir, cache=None):
+        self.repo_dir = repo_dir
+        self.cache = cache if cache is not None else CommitCache()
+        self.current_branch = None
+
+    def git(self, *args, check=True):
+        return subprocess.run(
+            ["git", *args],
             cwd=self.repo_dir,
             universal_newlines=True,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            check=True,
+            check=check,
         )
-        lines = result.stdout.splitlines()
-        if len(lines) % 2 != 0:
-            raise RuntimeError("Expecting an even number of lines from command {cmd}.  It should produce exactly two lines per commit")
-        for info, message in zip(lines[::2], lines[1::2]):
-            words = info.split()
+
+    def tips(self):
+        """ Commit of each local branch and of HEAD by name """
+        tips = {}
+        head = None
+        # %(refname:short) can give 'heads/x' when a tag is also named x
+        result = self.git("for-each-ref", "--format=%(objectname)%00%(HEAD)%00%(refname)", "refs/heads")
+        for line in result.stdout.splitlines():
+            sha, current, name = line.split('\0', 2)
+            name = name[len("refs/heads/"):]
+            tips[name] = sha
+            if current == '*':
+                head = sha
+                self.current_branch = name
+        if head is None:
+            # Detached HEAD or repo without commits
+            head = self.git("rev-parse", "-q", "--verify", "HEAD", check=False).stdout.strip() or None
+        if head is not None:
+            tips['HEAD'] = head
+        return tips
+
+    def walk(self, include, exclude, since):
+        """ Add the commits made since the timestamp since that are reachable
+        from include but not from exclude to the cache with a single
+        'git log' """
+        cmd = ["log", "-z", f"--since=@{since}", f"--format={self.FORMAT}", *include]
+        if exclude:
+            cmd += ["--not", *exclude]
+        result = self.git(*cmd)
+        for record in result.stdout.split('\0'):
+            if not record:
+                continue
+            fields = record.split('\x1f')
+            if len(fields) != 7:
+                raise RuntimeError(f"Unexpected output from command {cmd}: {record!r}")
+            self.cache.commits[fields[0]] = {
+                'parents': tuple(fields[1].split()),
+                'committed': int(fields[2]),
+                'date': int(fields[3]),
+                'email': fields[4],
+                'author': fields[5],
+                'message': fields[6],
+            }
+
+    def update_cache(self, since):
+        """ Bring the cache up to date with the current tips, covering at
+        least the commits made since the timestamp since """
+        cache = self.cache
+        tips = self.tips()
+        if cache.since is None or since < cache.since:
+            cache.reset(since)
+        cache.prune(since)
+        if tips == cache.tips:
+            return
+        include = sorted({sha for name, sha in tips.items() if cache.tips.get(name) != sha})
+        exclude = sorted(set(cache.tips.values()) - set(include))
+        try:
+            self.walk(include, exclude, cache.since)
+        except subprocess.CalledProcessError:
+            if not exclude:
+                raise
+            # An old tip was garbage collected, walk everything again
+            cache.reset(cache.since)
+            self.walk(sorted(set(tips.values())), [], cache.since)
+        cache.tips = tips
+        cache.label()
+        cache.modified = True
+
+    def commits_since(self, begin, all_branches=False):
+        """ Yield commits made since the datetime begin that are reachable
+        from HEAD or from any local branch if all_branches is True.
+
+        YIELDS: Dictionnaries of the form
+
+            {
+                'hash': <HASH>,
+                'branch': <BRANCH UNDER WHICH THE COMMIT IS SHOWN>,
+                'branches': <LOCAL BRANCHES FROM WHICH IT IS REACHABLE>,
+                'date': <AUTHOR DATE, DATETIME OBJECT>,
+                'committed': <COMMITTER DATE, DATETIME OBJECT>,
+                'email': <AUTHOR EMAIL>,
+                'author': <AUTHOR NAME>,
+                'message': <SUBJECT>
+            }
+
+        Implementation details:
+
+        Commits come from the commit cache which only needs one 'for-each-ref'
+        and, if some branch moved, one 'git log' for the new commits.  Each
+        commit is listed once even if it is on several branches and is shown
+        under the current branch if it is on it.
+        """
+        since = int(begin.timestamp())
+        self.update_cache(since)
+        self.cache.save()
+        for h, c in self.cache.commits.items():
+            if c['committed'] < since:
+                continue
+            branches = [b for b in c['branches'] if b != 'HEAD']
+            if all_branches:
+                if not branches:
+                    continue
+                branch = self.current_branch if self.current_branch in branches else branches[0]
+            else:
+                if 'HEAD' not in c['branches']:
+                    continue
+                branch = 'HEAD'
             yield {
-                "date": datetime.datetime.fromtimestamp(int(words[1])),
-                "hash": words[0],
-                "email": words[2],
-                "author": ' '.join(words[3:]),
-                "message": message
+                "hash": h,
+                "branch": branch,
+                "branches": branches,
+                "date": datetime.datetime.fromtimestamp(c['date']),
+                "committed": datetime.datetime.fromtimestamp(c['committed']),
+                "email": c['email'],
+                "author": c['author'],
+                "message": c['message']
             }
 
     def print_recent_commits(self, days=1):
-        self.print_branch_recent('HEAD', days=days)
+        self.print_branch_recent('HEAD', list(self.commits_since(window_start(days))), days=days)
 
     def all_recent(self, days=2):
-        for b in self.branches():
-            self.print_branch_recent(b, days=days)
-
-    def print_branch_recent(self, branch='HEAD', days=1):
-        now = datetime.date.today()
-        right_now = datetime.datetime.now()
-        yesterday = now - datetime.timedelta(days=1)
-        before_yesterday = now - datetime.timedelta(days=1+days)
+        by_branch = {}
+        for c in self.commits_since(window_start(days), all_branches=True):
+            by_branch.setdefault(c['branch'], []).append(c)
+        for b in sorted(by_branch):
+            self.print_branch_recent(b, by_branch[b], days=days)
 
-        today_commits = list(self.commits_between_dates(now, right_now, branch))
-        yesterday_commits = list(self.commits_between_dates(before_yesterday, now, branch))
+    def print_branch_recent(self, branch, commits, days=1):
+        today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+        # Commits are selected by committer date like 'git log --since' so a
+        # commit rebased today is in today's commits
+        today_commits = [c for c in commits if c['committed'] >= today]
+        yesterday_commits = [c for c in commits if c['committed'] < today]
 
         if today_commits:
             print(self.today_header(branch, days))
-            print_list(sorted(today_commits, key=lambda c: c["date"], reverse=True))
+            print_list(sorted(today_commits, key=lambda c: c["committed"], reverse=True))
 
         if yesterday_commits:
             print(self.past_header(branch, days))
-            print_list(sorted(yesterday_commits, key=lambda c: c["date"], reverse=True))
+            print_list(sorted(yesterday_commits, key=lambda c: c["committed"], reverse=True))
 
     def today_header(self, branch, days):
         return f"\033[1;37mToday's commits\033[0m" \
@@ -140,13 +376,30 @@ class Repo:
             else:
                 return f'\033[1;37mCommits made between yesterday and {days} days ago on branch \033[1;35m{branch}\033[1;37m\033[0m'
 
-def print_list(commit_list):
+def window_start(days):
+    """ Midnight 'days' days before yesterday """
+    return datetime.datetime.combine(datetime.date.today() - datetime.timedelta(days=1+days), datetime.time())
+
+def print_list(commit_list, show_branch=False):
     for c in commit_list:
-        print_commit(c)
+        print_commit(c, show_branch)
 
-def print_commit(c):
+def print_commit(c, show_branch=False):
     # print("\033[33m{}\033[0m {} - \033[32m{}\033[0m".format(c['hash'][:6], c['date'], c['message']))
-    print("\033[33m{}\033[0m {} - \033[34m{}\033[0m - \033[32m{}\033[0m".format(c['hash'][:6],c['date'],c['author'], c['message']))
+    where = ""
+    if 'repo' in c:
+        where = f"\033[1;36m{c['repo']}\033[0m"
+        if show_branch:
+            where += f"(\033[35m{c['branch']}\033[0m)"
+        where += " "
+    print("\033[33m{}\033[0m {} - {}\033[34m{}\033[0m - \033[32m{}\033[0m".format(c['hash'][:6],c['date'],where,c['author'], c['message']))
+
+def print_json(commits):
+    """ Print commits as a JSON array with dates in ISO 8601 format """
+    json.dump([dict(c, date=c['date'].astimezone().isoformat(), timestamp=int(c['date'].timestamp()),
+                    committed=c['committed'].astimezone().isoformat())
+               for c in commits], sys.stdout, indent=2)
+    print()
 
 if __name__ == "__main__":
     sys.exit(main())
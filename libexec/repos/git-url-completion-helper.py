@@ -1,9 +1,8 @@
 import sys
-import yaml
 import os
+import _repos_config
 
-with open(os.path.expanduser("~/.config/repos.yml")) as y:
-    domains = yaml.safe_load(y)['config']['domains']
+domains = _repos_config.load(read_only=True)['config']['domains']
 
 def complete_domains(protocol, domain_prefix):
     for d in domains:
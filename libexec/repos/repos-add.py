@@ -1,19 +1,32 @@
 #!/usr/bin/env python3
 
 import sys
-import yaml
 import argparse
+import itertools
 import os
 import _repos_logging
+import _repos_base
+import _repos_config
 
 logger = _repos_logging.logger
 
+DESCRIPTION = """Add repos to the repos.yml config file
+
+All the paths are checked and added with a single write of the config file.
+A repo is named after the basename of its path.  If that name is already used
+by another repo, the names of the parent directories are prepended one at a
+time ('b-repo', 'a-b-repo', ...) until a free name is found.  New repos are
+processed in sorted order of their paths so that the same input always gives
+the same names."""
+
 def arg_parser():
-    p = argparse.ArgumentParser(description="Add a repo to the repos.yml config file")
+    p = argparse.ArgumentParser(description=DESCRIPTION, formatter_class=argparse.RawDescriptionHelpFormatter)
 
     p.add_argument("-F", help="Specify alternate file to ~/.config/repos.yml")
-    p.add_argument("repo", help="Specify the repository, defaults to $PWD", nargs='?')
-    p.add_argument("--name", help="Specify name for repo in config file")
+    p.add_argument("repos", help="Paths of the repositories, defaults to $PWD", nargs='*', metavar='repo')
+    p.add_argument("--name", help="Specify name for repo in config file (only with a single repo)")
+    p.add_argument("--stdin", action='store_true', help="Read paths from stdin, one per line")
+    p.add_argument("-0", "--null", action='store_true', help="Paths read from stdin are separated by NUL characters (like the output of 'find -print0')")
     return p
 def get_args():
     p = arg_parser()
@@ -23,61 +36,100 @@ def get_args():
 
     args = p.parse_args()
 
-    if not args.repo:
-        args.repo = os.environ['PWD']
+    if args.null and not args.stdin:
+        p.error("--null requires --stdin")
 
-    if not os.path.isabs(args.repo):
-        args.repo = os.path.normpath(os.path.join(os.environ['PWD'], args.repo))
+    if args.stdin:
+        data = sys.stdin.buffer.read()
+        if args.null:
+            args.repos += [os.fsdecode(l) for l in data.split(b'\0') if l.strip()]
+        else:
+            # Surrounding whitespace and the '\r' of CRLF line endings are not
+            # part of the paths
+            args.repos += [os.fsdecode(l.strip()) for l in data.split(b'\n') if l.strip()]
+    elif not args.repos:
+        args.repos = [os.environ['PWD']]
 
-    if not args.name:
-        args.name = os.path.basename(args.repo)
+    args.repos = [os.path.normpath(os.path.join(os.environ['PWD'], os.path.expanduser(r))) for r in args.repos]
 
-    return args
-
-def main(args):
+    if args.name and len(args.repos) != 1:
+        p.error("--name can only be used with a single repo")
 
-    repo_file = args.F if args.F else os.path.expanduser("~/.config/repos.yml")
+    return args
 
-    #
-    # Create config file if it doesn't exist
-    #
-    if not os.path.isfile(repo_file):
-        os.makedirs(os.path.expanduser("~/.config"), exist_ok=True)
-        with open(repo_file, 'w') as f:
-            f.write('repos: {}\n')
+def candidate_names(path):
+    """ basename, parent-basename, grandparent-parent-basename, ... then
+    basename-2, basename-3, ... """
+    parts = [p for p in path.split(os.sep) if p]
+    for i in range(1, len(parts) + 1):
+        yield '-'.join(parts[-i:])
+    for i in itertools.count(2):
+        yield f"{parts[-1] if parts else 'root'}-{i}"
 
-    #
-    # Load repofile
-    #
-    with open(repo_file) as y:
-        repo_dict = yaml.safe_load(y)
-
-    #
-    # Check that it is a git repo by checking for a .git directory
-    #
-    if not (os.path.isdir(os.path.join(args.repo, '.git')) or os.path.isfile(os.path.join(args.repo, '.git'))):
-        logger.error(f"It seems repo '{args.repo}' is not a git repository, skipping ...")
-        return 1
+def main(args):
 
-    #
-    # Check if the repo is already there
-    #
-    if args.name in repo_dict['repos']:
-        logger.warn(f"Repo '{args.repo}' is already in '{repo_file}' under name '{args.name}' skipping ...")
-        return 0
+    repo_file = _repos_config.get_repo_file(args.F)
 
     #
-    # Add to the repo database
+    # Check that they are git repos by checking for a .git directory or file
+    # or for the layout of a bare repo
     #
-    repo_dict['repos'][args.name] = {"path": args.repo}
-    logger.info(f"Added '{args.repo}' to '{repo_file}' under name '{args.name}'")
-
+    paths = []
+    seen = set()
+    invalid = 0
+    for path in args.repos:
+        if path in seen:
+            continue
+        seen.add(path)
+        if not _repos_base.is_git_repo(path):
+            logger.error(f"It seems repo '{path}' is not a git repository, skipping ...")
+            invalid += 1
+            continue
+        paths.append(path)
+
+    if not paths:
+        return 1 if invalid else 0
 
     #
-    # Save back to file
+    # Load repofile, creating it if it doesn't exist, and save it back when
+    # done while holding the lock so that concurrent additions aren't lost
     #
-    with open(repo_file, 'w') as y:
-        yaml.dump(repo_dict,y)
+    added = present = 0
+    with _repos_config.transaction(repo_file) as repo_dict:
+        repos = repo_dict['repos']
+        index = _repos_config.make_index(repo_file, repo_dict)
+        # Real paths of the repos added by this command
+        new_paths = {}
+        for path in sorted(paths):
+            #
+            # Check if the repo is already there
+            #
+            real = os.path.realpath(path)
+            existing = new_paths.get(real) or index.find_by_path(path)
+            if existing is not None and existing in repos:
+                logger.info(f"Repo '{path}' is already in '{repo_file}' under name '{existing}'")
+                present += 1
+                continue
+
+            if args.name:
+                if args.name in repos:
+                    logger.warning(f"Name '{args.name}' is already used in '{repo_file}' by '{repos[args.name]['path']}', skipping '{path}' ...")
+                    return 1
+                name = args.name
+            else:
+                name = next(n for n in candidate_names(path) if n not in repos)
+
+            #
+            # Add to the repo database
+            #
+            repos[name] = {"path": path}
+            new_paths[real] = name
+            added += 1
+            logger.info(f"Added '{path}' to '{repo_file}' under name '{name}'")
+
+    if len(args.repos) > 1:
+        logger.info(f"Added {added} repos, {present} already present, {invalid} not git repos")
+    return 1 if invalid else 0
 
 if __name__ == "__main__":
     sys.exit(main(get_args()))
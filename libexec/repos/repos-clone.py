@@ -1,13 +1,13 @@
 #!/usr/bin/env python3
 
 import sys
-import yaml
 import argparse
 import os
 import subprocess
 import pathlib
 
 import _repos_logging
+import _repos_config
 import logging
 
 logger = _repos_logging.logger
@@ -98,9 +98,8 @@ def main():
     #
     # Load repofile
     #
-    repo_file = args.F if args.F else os.path.expanduser("~/.config/repos.yml")
-    with open(repo_file) as y:
-        repo_dict = yaml.safe_load(y)
+    repo_file = _repos_config.get_repo_file(args.F)
+    repo_dict = _repos_config.load(repo_file, read_only=True)
 
 
     if args.dest:
@@ -1,18 +1,19 @@
 #!/usr/bin/env python3
-import yaml
 import os
 import sys
 import argparse
+import contextlib
 import logging
 import _repos_logging
-import _repos_base
+import _repos_config
+import _repos_select
 
 logger = _repos_logging.logger
 
 def arg_parser():
-    p = argparse.ArgumentParser(description="Set the ignore flag of a repo to true")
+    p = argparse.ArgumentParser(description="Get, set or clear the comment of repos")
     p.add_argument("-F", help="Specify alternate file to ~/.config/repos.yml")
-    p.add_argument("--name", help="Specify name for repo in config file.  Defaults to basename(os.getcwd())")
+    _repos_select.add_arguments(p)
     p.add_argument("--debug", action='store_true')
     action = p.add_mutually_exclusive_group()
     action.add_argument("--get", help="Get comment for repo", action='store_true')
@@ -21,56 +22,64 @@ def arg_parser():
     return p
 
 def main():
-    args = arg_parser().parse_args()
+    p = arg_parser()
+    args = p.parse_args()
     if args.debug:
         logger.setLevel(logging.DEBUG)
-    repo_file = args.F if args.F else os.path.expanduser("~/.config/repos.yml")
+    _repos_select.check_arguments(p, args)
+    repo_file = _repos_config.get_repo_file(args.F)
 
-    if args.name is None:
-        repo_root = _repos_base.get_repo_root(os.getcwd())
-        if repo_root is None:
-            logger.error(f"No --name provided and could not find repo root starting at PWD")
-            return 1
-        logger.info(f"Using basename(REPO_ROOT): '{repo_root.name}' as repo name to commment")
-        args.name = os.path.basename(repo_root.name)
-
-    with open(repo_file) as f:
-        database = yaml.safe_load(f)
-
-    if args.name not in database['repos'] :
-        logger.error(f"No repo with name '{args.name}' in repo file '{repo_file}'")
+    if args.set == "":
+        logger.error(f"Use --clear to remove comments")
         return 1
 
-    repos = database['repos']
-    try:
-        repo = repos[args.name]
-    except KeyError as e:
-        logger.error(f"Repo '${args.name}' not found in repos section of repo_file '{repo_file}'")
-        return 1
+    bulk = _repos_select.is_bulk(args)
+    if args.name is None and not bulk:
+        args.name = _repos_select.default_name(repo_file)
+        if args.name is None:
+            return 1
 
-    if args.set or args.clear:
-        if args.set == "":
-            logger.error(f"Use --del to remove comments", file=sys.stderr)
+    # Only lock the config file if we are going to modify it
+    if args.get or args.dry_run:
+        database_context = contextlib.nullcontext(_repos_config.load(repo_file, read_only=True))
+    else:
+        database_context = _repos_config.transaction(repo_file, create_missing=False)
+
+    with database_context as database:
+        names = _repos_select.select(args, repo_file, database)
+        if names is None:
             return 1
-        if args.set:
-            if 'comment' in repo:
-                logger.error(f"Replacing previous comment '{repo['comment']}'")
-            logger.info(f"Setting comment to '{args.set}'")
-            repo['comment'] = args.set
-        elif args.clear:
-            if 'comment'in repo:
-                logger.info(f"Removing comment '{repo['comment']}'")
-                del repo['comment']
-        with open(repo_file, 'w') as f:
-            yaml.dump(database, f)
-    elif args.get:
-        if 'comment' in repo:
-            print(repo['comment'])
-        else:
-            logger.error("The repo '{args.name}' has no comment", file=sys.stderr)
+        if not names:
+            logger.warning(f"No repos selected")
             return 1
 
+        repos = database['repos']
+        missing = 0
+        for name in names:
+            repo = repos[name]
+            if args.set or args.clear:
+                if args.dry_run:
+                    print(f"{name}\t{repo['path']}\t{repo.get('comment', '')}")
+                if args.set:
+                    if 'comment' in repo:
+                        logger.warning(f"Replacing previous comment '{repo['comment']}' of repo '{name}'")
+                    logger.info(f"{'Would set' if args.dry_run else 'Setting'} comment of '{name}' to '{args.set}'")
+                    if not args.dry_run:
+                        repo['comment'] = args.set
+                elif args.clear:
+                    if 'comment' in repo:
+                        logger.info(f"{'Would remove' if args.dry_run else 'Removing'} comment '{repo['comment']}' of '{name}'")
+                        if not args.dry_run:
+                            del repo['comment']
+            elif args.get:
+                if 'comment' in repo:
+                    print(f"{name}\t{repo['comment']}" if bulk else repo['comment'])
+                elif not bulk:
+                    logger.error(f"The repo '{name}' has no comment")
+                    missing += 1
+            elif args.dry_run:
+                print(f"{name}\t{repo['path']}\t{repo.get('comment', '')}")
+        return 1 if missing else 0
+
 if __name__ == "__main__":
     sys.exit(main())
-
-
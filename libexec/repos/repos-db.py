@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+import sys
+import argparse
+import os
+import _repos_logging
+import _repos_config
+
+logger = _repos_logging.logger
+
+DESCRIPTION = """Move the repos between the YAML config file and the SQLite database.
+
+The SQLite backend is selected with 'backend: sqlite' in the 'config' section
+of the config file.  The 'repos' binary only reads the YAML file so after
+changing repos with the SQLite backend, use 'repos-db export' to update the
+'repos' section of the YAML file."""
+
+def arg_parser():
+    p = argparse.ArgumentParser(description=DESCRIPTION, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("-F", help="Specify alternate file to ~/.config/repos.yml")
+    sub = p.add_subparsers(dest='command', required=True)
+
+    imp = sub.add_parser("import", help="Copy the repos of a YAML file into the database")
+    imp.add_argument("--from", dest="source", help="YAML file to read repos from, defaults to the config file")
+    imp.add_argument("--replace", action='store_true', help="Remove repos of the database that are not in the YAML file")
+    imp.add_argument("--enable", action='store_true', help="Set 'backend: sqlite' in the config file after importing")
+
+    exp = sub.add_parser("export", help="Write the repos of the database in YAML")
+    exp.add_argument("-o", "--output", help="Write the config with the repos of the database to this file ('-' for stdout) instead of updating the config file")
+    return p
+
+def get_args():
+    return arg_parser().parse_args()
+
+def import_repos(args, repo_file):
+    with _repos_config.lock(repo_file):
+        config = _repos_config.load(repo_file, create_missing=True)
+        if args.source:
+            with open(args.source) as f:
+                source = (_repos_config.parse(f) or {}).get('repos') or {}
+        else:
+            source = _repos_config.yaml_config(config)['repos']
+        db = _repos_config.get_database(repo_file, config)
+        db.begin()
+        try:
+            if args.replace:
+                db.replace_all(source)
+            else:
+                for name, repo in source.items():
+                    db[name] = repo
+        except BaseException:
+            db.rollback()
+            raise
+        db.commit()
+        logger.info(f"Imported {len(source)} repos into '{db.filename}', it now has {len(db)} repos")
+
+    if args.enable:
+        with _repos_config.transaction(repo_file) as config:
+            config.setdefault('config', {})
+            if config['config'] is None:
+                config['config'] = {}
+            config['config']['backend'] = 'sqlite'
+        logger.info(f"Enabled the SQLite backend in '{repo_file}'")
+
+def export_repos(args, repo_file):
+    if args.output:
+        config = _repos_config.load(repo_file)
+        db = _repos_config.get_database(repo_file, config)
+        exported = {**_repos_config.yaml_config(config), 'repos': db.to_dict()}
+        if args.output == '-':
+            _repos_config.dump(exported, sys.stdout)
+        else:
+            _repos_config.save(args.output, exported)
+        logger.info(f"Exported {len(exported['repos'])} repos from '{db.filename}' to '{args.output}'")
+        return
+
+    with _repos_config.transaction(repo_file, create_missing=False) as config:
+        db = _repos_config.get_database(repo_file, config)
+        exported = db.to_dict()
+        if _repos_config.is_database(config['repos']):
+            db.yaml_repos = exported
+        else:
+            config['repos'] = exported
+        count, filename = len(exported), db.filename
+    logger.info(f"Exported {count} repos from '{filename}' to '{repo_file}'")
+
+def main(args):
+    repo_file = _repos_config.get_repo_file(args.F)
+    if args.command == 'import':
+        import_repos(args, repo_file)
+    elif args.command == 'export':
+        if not os.path.exists(repo_file):
+            logger.error(f"Config file '{repo_file}' does not exist")
+            return 1
+        export_repos(args, repo_file)
+
+if __name__ == "__main__":
+    sys.exit(main(get_args()))
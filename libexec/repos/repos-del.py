@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 import sys
-import yaml
 import argparse
 import os
 import subprocess
@@ -9,6 +8,7 @@ import logging
 import pathlib
 
 import _repos_logging
+import _repos_config
 
 logger = _repos_logging.logger
 
@@ -41,27 +41,27 @@ def get_args():
 
     return args
 
-def find_repo_by_path(repos, path):
-    for name, repo in repos.items():
-        if repo['path'] == path:
-            return name, repo
-    return None, None
-
 def main():
     args = get_args()
-    repo_file = args.F if args.F else os.path.expanduser("~/.config/repos.yml")
-    with open(repo_file) as y:
-        config = yaml.safe_load(y)
+    repo_file = _repos_config.get_repo_file(args.F)
+    config = _repos_config.load(repo_file, read_only=True)
 
     repos = config['repos']
     if not args.name:
+        index = _repos_config.get_index(repo_file)
         if not args.path:
-            name, repo = find_repo_by_path(repos, os.environ['PWD']) or find_repo_by_path(repos, os.getcwd())
+            # Only the root of a repo designates it: deleting the repo
+            # containing PWD from some subdirectory would be a surprise.
+            pwd = os.environ.get('PWD', os.getcwd())
+            args.name = index.find_by_path(pwd) or index.find_by_path(os.getcwd())
+            if args.name is None:
+                containing = index.find_containing(pwd) or index.find_containing(os.getcwd())
+                if containing is not None:
+                    logger.error(f"PWD is inside repo '{containing}' but not at its root '{repos[containing]['path']}', refusing to guess.  Use --name or --path to delete it.")
+                    return 1
         else:
-            name, repo = find_repo_by_path(args.path) or find_repo_by_path(os.path.realpath(args.path))
-        args.name = name
-    else:
-        repo = repos.get(args.name)
+            args.name = index.find_by_path(args.path)
+    repo = repos.get(args.name)
 
     if repo is None:
         logger.error(f"No such repo '{args.name}'")
@@ -83,10 +83,12 @@ def main():
     except FileNotFoundError as e:
         logger.info(f"Repo not found: {e}")
 
-    del config['repos'][args.name]
-
-    with open(repo_file, 'w') as y:
-        yaml.dump(config,y)
+    # The config was read without locking it since we don't want to hold the
+    # lock while waiting for the user to answer.  Remove the entry from a
+    # fresh copy so that changes made in the meantime are not lost.
+    with _repos_config.transaction(repo_file, create_missing=False) as config:
+        if config['repos'].get(args.name, {}).get('path') == repo['path']:
+            del config['repos'][args.name]
 
     logger.info(f"Repo removed from repo_file '{repo_file}'")
 
@@ -1,12 +1,20 @@
 #!/usr/bin/env python3
 import os
-import yaml
+import json
 import argparse
+import errno
 import pprint
 import sys
 import re
+import time
 import _repos_logging
+import _repos_base
+import _repos_config
+import _repos_inotify
+import _repos_probe
+import _repos_walk
 import logging
+import signal
 
 logger = _repos_logging.logger
 
@@ -16,10 +24,20 @@ def arg_parser():
     p.add_argument("--recursive", action='store_true', help="Search recursively")
     p.add_argument("--debug", action="store_true", help="Print current search dir to STDERR")
     p.add_argument("--merge", action='store_true', help="Merge with repo file")
-    p.add_argument("-F", dest='repo_file', metavar="CONFIG_FILE", help="Alternate repo-file, defaults to ~/.config/repos.yml", default=os.path.expanduser("~/.config/repos.yml"))
+    p.add_argument("-F", dest='repo_file', metavar="CONFIG_FILE", help="Alternate repo-file, defaults to ~/.config/repos.yml", default=_repos_config.DEFAULT_REPO_FILE)
     p.add_argument("--exclude", help="Regular expression to exclude")
     p.add_argument("--include", help="Regular expression to include")
     p.add_argument("--cleanup", action='store_true', help="Remove repos that don't exist anymore.  Only valid when using the --merge option")
+    p.add_argument("--probe-timeout", type=float, metavar='SECONDS', default=_repos_probe.DEFAULT_TIMEOUT, help=f"With --merge and --cleanup, paths that take longer than SECONDS to check are treated as unknown and their repos are kept (default {_repos_probe.DEFAULT_TIMEOUT})")
+    p.add_argument("--watch", action='store_true', help="After merging the repos found in DIRS, keep running and update the config file when repos are created or deleted in DIRS (Linux only), implies --merge and --recursive")
+    p.add_argument("--prune", action='append', default=[], metavar='RULE', help="Don't search directories matching RULE (glob, or regex if prefixed with 're:'), can be repeated.  Added to the rules in the 'prune' list of the config section of the config file")
+    p.add_argument("--max-depth", type=int, metavar='N', help="Search at most N levels below DIRS, implies --recursive")
+    p.add_argument("--format", choices=['yaml', 'ndjson', 'paths'], default='yaml', help="Output format when not using --merge.  Each repo is printed as soon as it is found (default yaml)")
+    p.add_argument("--stats", action='store_true', help="Print a summary of directories visited and pruned to STDERR")
+    p.add_argument("--incremental", action='store_true', help="Use a cache of the previous scans to only list directories that have changed")
+    p.add_argument("--rebuild-cache", action='store_true', help="Discard the scan cache and rebuild it, implies --incremental")
+    p.add_argument("--cache-file", help="Scan cache file for --incremental, defaults to ~/.cache/repos/find-cache.pickle")
+    p.add_argument("-j", "--jobs", type=int, default=_repos_walk.DEFAULT_JOBS, help=f"Number of directories to scan concurrently (default {_repos_walk.DEFAULT_JOBS})")
 
     return p
 
@@ -42,54 +60,310 @@ def get_args():
     if args.debug:
         logger.setLevel(logging.DEBUG)
 
-    return args
+    if args.watch:
+        args.merge = True
+        args.recursive = True
 
-def is_git_repo(path):
-    try:
-        if not os.path.isdir(path):
-            return False
-        contents = os.listdir(path)
+    if args.max_depth is not None:
+        if args.max_depth < 1:
+            logger.error("--max-depth must be at least 1")
+            sys.exit(1)
+        args.recursive = True
+    elif not args.recursive:
+        args.max_depth = 1
 
-        if '.git' in contents:
-            return True
+    if args.rebuild_cache:
+        args.incremental = True
+    if args.incremental and not args.cache_file:
+        args.cache_file = os.path.join(_repos_base.get_cache_dir(), "find-cache.pickle")
 
-        if 'branches' in contents and 'refs' in contents and 'objects' in contents and 'packed-refs' in contents:
-            return True
+    return args
 
-    except PermissionError:
-        return False
+def get_prune_rules(args):
+    rules = []
+    if os.path.isfile(args.repo_file):
+        config = _repos_config.load(args.repo_file, read_only=True).get('config') or {}
+        config_rules = config.get('prune') or []
+        if not isinstance(config_rules, list):
+            logger.warning(f"Ignoring 'prune' in config section of '{args.repo_file}': it should be a list")
+            config_rules = []
+        rules += [str(r) for r in config_rules]
+    return rules + args.prune
 
-    return False
+class RepoPrinter:
+    """ Print repos on STDOUT as they are found, flushing after each one so
+    that results can be piped into other tools while the search is going on.
+    Nothing is accumulated so memory use does not depend on the number of
+    repos found. """
+    def __init__(self, fmt, out=sys.stdout):
+        self.fmt = fmt
+        self.out = out
+        self.count = 0
 
-def find_git_repos_in(directory, recurse, args):
-    logger.debug(f"Doing directory {directory}")
-    try:
-        contents = os.listdir(directory)
-    except PermissionError:
-        return
-    except NotADirectoryError:
-        return
-    except FileNotFoundError as e:
-        logger.warn(f"FileNotFoundError: {e}")
+    def print(self, name, repo):
+        if self.fmt == 'yaml':
+            if self.count == 0:
+                self.out.write("repos:\n")
+            self.out.write(f"  {name}: {{path: {repo['path']}}}\n")
+        elif self.fmt == 'ndjson':
+            self.out.write(json.dumps({'name': name, 'path': repo['path']}) + "\n")
+        elif self.fmt == 'paths':
+            self.out.write(f"{repo['path']}\n")
+        self.out.flush()
+        self.count += 1
+
+def prefetch_paths(prober, base_rf, repos, cleanup):
+    """ Check all the paths that merge_repos() and cleanup_repos() will need
+    in one batch and report how long it took """
+    paths = [r['path'] for k, r in repos]
+    paths += [base_rf['repos'][k]['path'] for k, r in repos if k in base_rf['repos']]
+    if cleanup:
+        paths += [v['path'] for v in base_rf['repos'].values()]
+    if not paths:
         return
+    elapsed, unknown = prober.prefetch(paths)
+    msg = f"Checked {len(set(paths))} paths in {elapsed:.2f}s"
+    if unknown:
+        msg += f", {unknown} could not be checked within {prober.timeout}s"
+    logger.info(msg)
+
+def merge_repos(base_rf, repos, prober, repo_file):
+    """ Add repos to base_rf['repos'], return the list of repos that could not
+    be added because their name is already used by an existing repo.  Repos
+    whose path or real path is already in base_rf under any name are
+    skipped. """
+    clashes = []
+    # The paths of base_rf as they are now, it may have been changed since it
+    # was loaded, and the index for real paths which are expensive to resolve
+    paths = {os.path.normpath(os.path.expanduser(v['path'])): n for n, v in base_rf['repos'].items()}
+    realpaths = {}
+    index = _repos_config.make_index(repo_file, base_rf)
+    # Every new path is probed below so do it in one batch, this does nothing
+    # for the paths prefetch_paths() already checked.
+    prober.prefetch([r['path'] for k, r in repos]
+                    + [base_rf['repos'][k]['path'] for k, r in repos if k in base_rf['repos']])
+    for k,r in repos:
+        r['path'] = os.path.normpath(r['path'])
+        existing = paths.get(r['path'])
+        info = prober.info(r['path'])
+        if existing is None and info is not None:
+            existing = realpaths.get(info.realpath)
+            candidate = index.find_by_path(info.realpath)
+            if existing is None and candidate in base_rf['repos'] \
+                    and os.path.realpath(os.path.expanduser(base_rf['repos'][candidate]['path'])) == info.realpath:
+                existing = candidate
+        if existing is not None and existing in base_rf['repos']:
+            logger.debug(f"Repo at path '{r['path']}' is already present under name '{existing}'")
+            continue
+        if k not in base_rf['repos']:
+            logger.info(f"Adding repo '{k}' at path '{r['path']}'")
+            base_rf['repos'][k] = r
+            paths[r['path']] = k
+            if info is not None:
+                realpaths[info.realpath] = k
+        else:
+            original_repo = base_rf['repos'][k]
+            original = prober.info(original_repo['path'])
+            new = prober.info(r['path'])
+            if original is None or new is None:
+                logger.warning(f"Could not check paths of repo under name '{k}' at path '{original_repo['path']}', not adding repo '{r['path']}'")
+                clashes.append((k,r))
+            elif original.realpath != new.realpath:
+                if original.isdir:
+                    logger.warning(f"Repo under name '{k}' exists at path '{original_repo['path']}, not adding repo '{r['path']}'")
+                    clashes.append((k,r))
+                else:
+                    logger.info(f"Repo under name '{k}' at path '{original_repo['path']}' doesn't exist, replacing with '{r['path']}'")
+                    base_rf['repos'][k] = r
+                    paths[r['path']] = k
+                    realpaths[new.realpath] = k
+    return clashes
+
+def cleanup_repos(base_rf, prober, roots=None):
+    """ Remove repos whose path does not exist, only looking at the ones under
+    roots if roots are given.  Repos whose path could not be checked are
+    kept. """
+    for k, v in list(base_rf['repos'].items()):
+        if roots is not None and not any(is_under(v['path'], r) for r in roots):
+            continue
+        info = prober.info(v['path'])
+        if info is None:
+            logger.warning(f"Keeping key {k}: could not check if path {v['path']} exists")
+        elif not info.isdir:
+            logger.info(f"Deleting key {k}: path {v['path']} does not exist")
+            del base_rf['repos'][k]
+
+def remove_repos_under(base_rf, path):
+    for k, v in list(base_rf['repos'].items()):
+        if is_under(v['path'], path):
+            logger.info(f"Deleting key {k}: path {v['path']} was removed")
+            del base_rf['repos'][k]
+
+def move_repos_under(base_rf, old, new):
+    for k, v in base_rf['repos'].items():
+        if is_under(v['path'], old):
+            path = os.path.normpath(os.path.join(new, os.path.relpath(os.path.normpath(v['path']), old)))
+            logger.info(f"Repo '{k}' moved from '{v['path']}' to '{path}'")
+            v['path'] = path
+
+def is_under(path, directory):
+    path = os.path.normpath(path)
+    return path == directory or path.startswith(os.path.join(directory, ''))
+
+class Watcher:
+    """ Keep the config file in sync with the repos under some directories.
+
+    After an initial scan of the directories, every directory that is not a
+    repo is watched with inotify.  Directories that get created or moved in
+    are scanned for repos and repos that get deleted or moved out are removed
+    from the config file.  A directory becomes a repo when a '.git' (or the
+    files of a bare repo) appears in it, which is how 'git clone' and
+    'git init' look from the outside.
 
-    dirs = filter(lambda c: not c.startswith("."), contents)
-    dirs = set(filter(lambda d:os.path.isdir(os.path.join(directory, d)), dirs))
-    if args.include and args.exclude:
-        dirs = filter(lambda d: (not args.exclude.search(d)) or (args.include.search(d)), dirs)
-    elif args.include:
-        dirs = filter(lambda d: args.include.search(d), dirs)
-    elif args.exclude:
-        dirs = filter(lambda d: not args.exclude.search(d), dirs)
-    for d in dirs:
-        abs_dir=os.path.join(directory,d)
-        if is_git_repo(abs_dir):
-            name = os.path.basename(d)
-            logger.debug(f"Yielding ({name}, {{'path': '{abs_dir}'}})")
-            yield (name, {'path': os.path.normpath(abs_dir)})
-        elif recurse:
-            logger.debug(f"Recursing into directory {d}")
-            yield from find_git_repos_in(os.path.join(directory, d), recurse, args)
+    Events that arrive together (like all the ones from an 'rm -rf') are
+    handled as one batch with a single write of the config file.
+    """
+    MASK = (_repos_inotify.IN_CREATE | _repos_inotify.IN_DELETE
+            | _repos_inotify.IN_MOVED_FROM | _repos_inotify.IN_MOVED_TO
+            | _repos_inotify.IN_DELETE_SELF | _repos_inotify.IN_MOVE_SELF
+            | _repos_inotify.IN_ONLYDIR)
+    REPO_MARKERS = {'.git', 'HEAD', 'objects', 'refs'}
+    # Time to wait for more events after the first one of a batch
+    BATCH_DELAY = 0.5
+
+    def __init__(self, args, walker, roots):
+        self.args = args
+        self.walker = walker
+        self.roots = roots
+        self.inotify = _repos_inotify.Inotify()
+        self.watches = {}
+        self.wds = {}
+        # Operations to apply to the config file in the order in which they
+        # happened: ('add', [(name, repo), ...]), ('remove', path),
+        # ('move', (old, new)) or ('cleanup', roots)
+        self.pending = []
+        # Directories moved out of a watched directory by cookie so that a
+        # rename keeps the attributes of the repos (comment, ignore, ...)
+        self.moved_from = {}
+        self.walker.on_dir = self.add_watch
+
+    def add_watch(self, path, depth):
+        max_depth = self.walker.max_depth
+        if max_depth is not None and depth >= max_depth:
+            return
+        try:
+            wd = self.inotify.add_watch(path, self.MASK)
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                logger.error(f"Cannot watch '{path}': inotify watch limit reached, see /proc/sys/fs/inotify/max_user_watches")
+            else:
+                logger.warning(f"Cannot watch '{path}': {e}")
+            return
+        self.watches[wd] = (path, depth)
+        self.wds[path] = wd
+
+    def remove_watches_under(self, path):
+        for p in [p for p in self.wds if is_under(p, path)]:
+            wd = self.wds.pop(p)
+            self.watches.pop(wd, None)
+            self.inotify.rm_watch(wd)
+
+    def scan(self, path, depth):
+        found = list(self.walker.walk(path, depth))
+        if found:
+            self.pending.append(('add', found))
+
+    def rescan(self):
+        for wd in list(self.watches):
+            self.inotify.rm_watch(wd)
+        self.watches = {}
+        self.wds = {}
+        for root in self.roots:
+            self.scan(root, 0)
+        self.pending.append(('cleanup', self.roots))
+
+    def handle(self, event):
+        if event.mask & _repos_inotify.IN_Q_OVERFLOW:
+            logger.warning("Some filesystem events were lost, rescanning all directories")
+            self.rescan()
+            return
+        if event.mask & _repos_inotify.IN_IGNORED:
+            path, _ = self.watches.pop(event.wd, (None, None))
+            if path is not None and self.wds.get(path) == event.wd:
+                del self.wds[path]
+            return
+        if event.wd not in self.watches:
+            return
+        directory, depth = self.watches[event.wd]
+        if event.mask & (_repos_inotify.IN_DELETE_SELF | _repos_inotify.IN_MOVE_SELF):
+            # The parent directory also gets an event for this unless this
+            # is one of the top directories.
+            if directory in self.roots:
+                logger.warning(f"Watched directory '{directory}' was removed")
+                self.remove_watches_under(directory)
+                self.pending.append(('remove', directory))
+            return
+
+        path = os.path.join(directory, event.name)
+        if event.mask & (_repos_inotify.IN_CREATE | _repos_inotify.IN_MOVED_TO):
+            if event.mask & _repos_inotify.IN_MOVED_TO and event.cookie in self.moved_from:
+                index = self.moved_from.pop(event.cookie)
+                old = self.pending[index][1]
+                self.pending[index] = ('move', (old, path))
+            if event.name in self.REPO_MARKERS and _repos_base.is_git_repo(directory):
+                logger.debug(f"Directory '{directory}' became a repo")
+                self.remove_watches_under(directory)
+                self.pending.append(('add', [(os.path.basename(directory), {'path': directory})]))
+            elif event.mask & _repos_inotify.IN_ISDIR and self.walker.pruner.keep(event.name, path):
+                logger.debug(f"New directory '{path}'")
+                self.scan(path, depth + 1)
+        elif event.mask & (_repos_inotify.IN_DELETE | _repos_inotify.IN_MOVED_FROM):
+            if event.mask & _repos_inotify.IN_ISDIR:
+                logger.debug(f"Directory '{path}' removed")
+                self.remove_watches_under(path)
+                if event.mask & _repos_inotify.IN_MOVED_FROM:
+                    self.moved_from[event.cookie] = len(self.pending)
+                self.pending.append(('remove', path))
+
+    def sync(self):
+        if not self.pending:
+            return
+        # Paths are checked again at each sync since they may have changed
+        prober = _repos_probe.PathProber(jobs=self.args.jobs, timeout=self.args.probe_timeout)
+        with _repos_config.transaction(self.args.repo_file) as base_rf:
+            for op, arg in self.pending:
+                if op == 'add':
+                    merge_repos(base_rf, arg, prober, self.args.repo_file)
+                elif op == 'remove':
+                    remove_repos_under(base_rf, arg)
+                elif op == 'move':
+                    move_repos_under(base_rf, *arg)
+                elif op == 'cleanup':
+                    cleanup_repos(base_rf, prober, roots=arg)
+        self.pending = []
+        self.moved_from = {}
+
+    def run(self):
+        def terminate(signum, frame):
+            sys.exit(0)
+        signal.signal(signal.SIGTERM, terminate)
+        logger.info(f"Watching {len(self.watches)} directories for changes")
+        try:
+            while True:
+                events = self.inotify.read()
+                while True:
+                    more = self.inotify.read(timeout=self.BATCH_DELAY)
+                    if not more:
+                        break
+                    events += more
+                for event in events:
+                    self.handle(event)
+                self.sync()
+        except KeyboardInterrupt:
+            return 130
+        finally:
+            self.sync()
+            self.inotify.close()
 
 def soft_update(original, new):
     """ Update original with keys that are in new but not already in original """
@@ -97,54 +371,67 @@ def soft_update(original, new):
 def main():
     args = get_args()
     # TODO: Should be just a list of paths
+    cache = _repos_walk.ScanCache(args.cache_file, rebuild=args.rebuild_cache) if args.incremental else None
+    pruner = _repos_walk.Pruner(get_prune_rules(args), include=args.include, exclude=args.exclude)
+    walker = _repos_walk.Walker(pruner=pruner, max_depth=args.max_depth,
+                                jobs=args.jobs, cache=cache)
+    roots = [os.path.normpath(os.path.join(os.getcwd(), d)) for d in args.dirs]
+    if args.watch:
+        # Created before the initial scan so that it can set its watches on
+        # the directories as they are found.
+        try:
+            watcher = Watcher(args, walker, roots)
+        except OSError as e:
+            logger.error(f"Cannot watch directories: {e}")
+            return 1
+    start = time.monotonic()
+    # With --merge, the results are needed to update the config file, otherwise
+    # they are printed as they come.
     repos = []
+    printer = RepoPrinter(args.format)
     try:
-        for d in args.dirs:
-            if not os.path.isabs(d):
-                d = os.path.join(os.getcwd(), d)
-            if is_git_repo(d):
-                # find_git_repos_in checks if the the directory *contains* git repos
-                # but not if the directory itself is a git repo.  This could be
-                # made more elegant.
-                repos.append((os.path.basename(d), {"path": d}))
-            else:
-                repos += find_git_repos_in(d, args.recursive, args)
+        for d in roots:
+            for name, repo in walker.walk(d):
+                if args.merge:
+                    repos.append((name, repo))
+                else:
+                    printer.print(name, repo)
     except KeyboardInterrupt:
-        logger.info("KeyboardInterrupt, results so far:")
-        yaml.dump({'repos': repos})
+        if args.merge:
+            logger.info(f"KeyboardInterrupt, not merging, results so far:")
+            for name, repo in repos:
+                printer.print(name, repo)
+        else:
+            logger.info(f"KeyboardInterrupt, search interrupted after {printer.count} repos")
         return 130
+    except BrokenPipeError:
+        # The reader of our output went away (like with '| head'), point
+        # STDOUT to /dev/null so that Python doesn't complain when it flushes
+        # STDOUT at exit.
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        return 1
+    if args.stats:
+        stats = walker.stats
+        logger.info(f"Visited {stats['visited']} directories in {time.monotonic() - start:.2f}s, found {stats['repos']} repos")
+        logger.info(f"Pruned {stats['pruned']} directories, {stats['depth-limited']} not searched because of the depth limit")
+    if cache is not None:
+        logger.info(f"Scan cache: {cache.hits} directories unchanged, {cache.misses} listed")
+        # Only a scan that was not limited or filtered sees everything under
+        # its roots so only then can the entries it didn't see be dropped.
+        # Prune rules are fine since they are applied the same way each time.
+        complete = args.max_depth is None and not (args.include or args.exclude)
+        cache.save(complete_roots=roots if complete else ())
     if args.merge:
-        clashes = []
-        if not os.path.exists(args.repo_file):
-            open(args.repo_file, 'w').write('repos: {}\n')
-        with open(args.repo_file, 'r') as f:
-            base_rf = yaml.safe_load(f)
-            for k,r in repos:
-                if k not in base_rf['repos']:
-                    logger.info(f"Adding repo '{k}' at path '{r['path']}'")
-                    base_rf['repos'][k] = r
-                else:
-                    original_repo = base_rf['repos'][k]
-                    if os.path.realpath(original_repo['path']) != os.path.realpath(r['path']):
-                        if os.path.isdir(original_repo['path']):
-                            logger.warning(f"Repo under name '{k}' exists at path '{original_repo['path']}, not adding repo '{r['path']}'")
-                            clashes.append((k,r))
-                        else:
-                            logger.info(f"Repo under name '{k}' at path '{r['path']}' doesn't exist, replacing with '{r['path']}'")
-                            base_rf['repos'][k] = r
-        if args.cleanup:
-            for k in list(base_rf['repos'].keys()):
-                v = base_rf['repos'][k]
-                if not os.path.isdir(v['path']):
-                    logger.info(f"Deleting key {k}: path {v['path']} does not exist")
-                    del base_rf['repos'][k]
-        with open(args.repo_file, 'w') as f:
-            yaml.dump(base_rf, f)
-    else:
-        if repos:
-            print("repos:")
-            for k, v in repos:
-                print(f"  {k}: {{path: {v['path']}}}")
+        prober = _repos_probe.PathProber(jobs=args.jobs, timeout=args.probe_timeout)
+        with _repos_config.transaction(args.repo_file) as base_rf:
+            prefetch_paths(prober, base_rf, repos, args.cleanup)
+            merge_repos(base_rf, repos, prober, args.repo_file)
+            if args.cleanup:
+                cleanup_repos(base_rf, prober)
+
+    if args.watch:
+        return watcher.run()
 
 if __name__ == "__main__":
     sys.exit(main())
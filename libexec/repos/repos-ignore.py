@@ -1,64 +1,76 @@
 #!/usr/bin/env python3
-import yaml
 import os
 import sys
 import argparse
+import contextlib
 import logging
 
 import _repos_logging
-import _repos_base
+import _repos_config
+import _repos_select
 
 logger = _repos_logging.logger
 
 def arg_parser():
-    p = argparse.ArgumentParser(description="Set the ignore flag of a repo to true")
+    p = argparse.ArgumentParser(description="Set the ignore flag of repos to true")
     p.add_argument("-F", help="Specify alternate file to ~/.config/repos.yml")
-    p.add_argument("--name", help="Specify name for repo in config file.  Defaults to basename(os.getcwd())")
-    p.add_argument("--unignore", help="Unignore the repo", action='store_true')
+    _repos_select.add_arguments(p)
+    p.add_argument("--unignore", help="Unignore the repos", action='store_true')
     p.add_argument("--debug", action='store_true')
     return p
 
 def get_args():
-    args = arg_parser().parse_args()
+    p = arg_parser()
+    args = p.parse_args()
     if args.debug:
         logger.setLevel(logging.DEBUG)
+    _repos_select.check_arguments(p, args)
     return args
 
 def main():
     args = get_args()
-    repo_file = args.F if args.F else os.path.expanduser("~/.config/repos.yml")
+    repo_file = _repos_config.get_repo_file(args.F)
 
-    if args.name is None:
-        repo_root = _repos_base.get_repo_root(os.getcwd())
-        if repo_root is None:
-            logger.error(f"No --name provided and could not find repo root starting at PWD")
+    if args.name is None and not _repos_select.is_bulk(args):
+        args.name = _repos_select.default_name(repo_file)
+        if args.name is None:
             return 1
-        logger.info(f"Using basename(REPO_ROOT): '{repo_root.name}' as repo name to commment")
-        args.name = os.path.basename(repo_root.name)
 
-    with open(repo_file) as f:
-        database = yaml.safe_load(f)
-
-    if args.name not in database['repos'] :
-        logger.error(f"No repo with name '{args.name}' in repo file '{repo_file}'")
-        return 1
-
-    repo = database['repos'][args.name]
-    if args.unignore:
-        if 'ignore' in repo:
-            del repo['ignore']
+    # Only lock the config file if we are going to modify it
+    if args.dry_run:
+        database_context = contextlib.nullcontext(_repos_config.load(repo_file, read_only=True))
     else:
-        if 'ignore' in repo and repo['ignore']:
-            logger.warning(f"Repo is already ignored")
-        else:
-            logger.info(f"Adding 'ignore: true' to repo '{args.name}'")
-            repo['ignore'] = True
+        database_context = _repos_config.transaction(repo_file, create_missing=False)
 
+    with database_context as database:
+        names = _repos_select.select(args, repo_file, database)
+        if names is None:
+            return 1
+        if not names:
+            logger.warning(f"No repos selected")
+            return 1
 
-    with open(repo_file, 'w') as f:
-        yaml.dump(database, f)
+        changed = 0
+        for name in names:
+            repo = database['repos'][name]
+            if args.unignore:
+                if 'ignore' in repo:
+                    logger.info(f"{'Would remove' if args.dry_run else 'Removing'} 'ignore' from repo '{name}'")
+                    if not args.dry_run:
+                        del repo['ignore']
+                    changed += 1
+            else:
+                if 'ignore' in repo and repo['ignore']:
+                    logger.warning(f"Repo '{name}' is already ignored")
+                else:
+                    logger.info(f"{'Would add' if args.dry_run else 'Adding'} 'ignore: true' to repo '{name}'")
+                    if not args.dry_run:
+                        repo['ignore'] = True
+                    changed += 1
+            if args.dry_run:
+                print(f"{name}\t{repo['path']}")
+        if len(names) > 1:
+            logger.info(f"{'Would change' if args.dry_run else 'Changed'} {changed} of {len(names)} selected repos")
 
 if __name__ == "__main__":
     sys.exit(main())
-
-
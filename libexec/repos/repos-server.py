@@ -2,8 +2,27 @@
 
 import http.server
 import argparse
+import collections
+import concurrent.futures
+import contextlib
+import email.utils
+import errno
+import gzip
+import hashlib
+import json
+import signal
+import sys
 import subprocess
 import os
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import _repos_base
+import _repos_config
+import _repos_inotify
+import _repos_status
 
 DESCRIPTION = "Server for repos"
 repos_root = os.path.normpath(f"{os.path.dirname(__file__)}/..")
@@ -11,18 +30,817 @@ repos_root = os.path.normpath(f"{os.path.dirname(__file__)}/..")
 content_types = {"css": "text/css", "html": "text/html", "json":
                  "application/json", "js": "text/javascript"}
 
+# Files bigger than this are not kept in memory but sent with sendfile()
+LARGE_FILE_SIZE = 256 * 1024
+# Files smaller than this are not worth compressing
+MIN_GZIP_SIZE = 1024
+
 def get_args():
     p = argparse.ArgumentParser(description=DESCRIPTION)
     p.add_argument("--port", "-p", type=int, help="Port to listen on", default=5447)
     p.add_argument("--host", help="Host to listen on", default="0.0.0.0")
     p.add_argument("--allowed-origins", help="Comma separated list of allowed origins")
+    p.add_argument("-F", dest="repo_file", help="Specify alternate file to ~/.config/repos.yml")
+    p.add_argument("--jobs", "-j", type=int, default=_repos_status.DEFAULT_JOBS, help="Number of repos whose status is computed at the same time")
+    p.add_argument("--engine", choices=['python', 'go'], default='python', help="Compute the status of repos with git commands run by the server (python) or by running the 'repos' program (go)")
+    p.add_argument("--no-fetch", action='store_true', help="Don't fetch repos before computing their status")
+    p.add_argument("--workers", "-w", type=int, default=16, help="Maximum number of requests handled at the same time, others wait in a queue")
+    p.add_argument("--cache-ttl", type=float, default=30, help="Seconds during which the status of the repos is reused for repos-data requests")
+    p.add_argument("--refresh-interval", type=float, default=0, help="Recompute the status of the repos in the background every this many seconds (0 to disable)")
+    p.add_argument("--watch", action='store_true', help="Watch the git metadata of the repos with inotify and only compute again the status of the repos that changed (requires --engine python)")
+    p.add_argument("--watch-ttl", type=float, default=300, help="With --watch, seconds after which the status of a watched repo is computed again even if nothing changed, to see unstaged changes and new commits on remotes")
+    p.add_argument("--reload-static", action='store_true', help="Reload viewer files that changed on disk instead of serving the copy loaded at startup")
+    p.add_argument("--shutdown-timeout", type=float, default=30, help="Seconds to wait for requests in progress when stopping")
     args = p.parse_args()
+    if args.watch and args.engine != 'python':
+        p.error("--watch requires --engine python")
     if args.allowed_origins:
         args.allowed_origins = args.allowed_origins.split(",")
     else:
         args.allowed_origins = []
     return args
 
+class Histogram:
+    """ Prometheus style histogram: cumulative counts of observations less
+    than or equal to each bucket bound, with their sum and count """
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+    def __init__(self):
+        self.counts = [0] * len(self.BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        for bound, count in zip(self.BUCKETS, self.counts):
+            yield f'{name}_bucket{{{labels},le="{bound}"}} {count}'
+        yield f'{name}_bucket{{{labels},le="+Inf"}} {self.count}'
+        yield f'{name}_sum{{{labels}}} {self.sum}'
+        yield f'{name}_count{{{labels}}} {self.count}'
+
+class Metrics:
+    """ Counters and histograms about requests and the 'repos' processes
+    that the server runs, exposed in the Prometheus text format """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = collections.Counter()
+        self.request_durations = collections.defaultdict(Histogram)
+        self.processes = collections.Counter()
+        self.process_durations = collections.defaultdict(Histogram)
+        self.in_flight = collections.Counter()
+
+    @contextlib.contextmanager
+    def request(self, endpoint):
+        """ Measure a request, the caller sets result['code'] """
+        result = {'code': 0}
+        with self.lock:
+            self.in_flight[endpoint] += 1
+        start = time.monotonic()
+        try:
+            yield result
+        finally:
+            duration = time.monotonic() - start
+            with self.lock:
+                self.in_flight[endpoint] -= 1
+                self.requests[(endpoint, result['code'])] += 1
+                self.request_durations[endpoint].observe(duration)
+
+    def run(self, kind, cmd, **kwargs):
+        """ subprocess.run() recording the duration and exit code """
+        start = time.monotonic()
+        result = subprocess.run(cmd, **kwargs)
+        self.process(kind, result.returncode, time.monotonic() - start)
+        return result
+
+    def process(self, kind, code, duration):
+        with self.lock:
+            self.processes[(kind, code)] += 1
+            self.process_durations[kind].observe(duration)
+
+    def text(self):
+        out = []
+        def metric(name, kind, help):
+            out.append(f"# HELP {name} {help}")
+            out.append(f"# TYPE {name} {kind}")
+        with self.lock:
+            metric("repos_server_requests_total", "counter", "Requests handled by endpoint and status code")
+            for (endpoint, code), n in sorted(self.requests.items()):
+                out.append(f'repos_server_requests_total{{endpoint="{endpoint}",code="{code}"}} {n}')
+            metric("repos_server_request_duration_seconds", "histogram", "Time to handle requests by endpoint")
+            for endpoint, h in sorted(self.request_durations.items()):
+                out.extend(h.lines("repos_server_request_duration_seconds", f'endpoint="{endpoint}"'))
+            metric("repos_server_requests_in_flight", "gauge", "Requests being handled by endpoint")
+            for endpoint, n in sorted(self.in_flight.items()):
+                out.append(f'repos_server_requests_in_flight{{endpoint="{endpoint}"}} {n}')
+            metric("repos_server_processes_total", "counter", "Processes run by kind and exit code")
+            for (kind, code), n in sorted(self.processes.items()):
+                out.append(f'repos_server_processes_total{{kind="{kind}",code="{code}"}} {n}')
+            metric("repos_server_process_duration_seconds", "histogram", "Duration of processes by kind")
+            for kind, h in sorted(self.process_durations.items()):
+                out.extend(h.lines("repos_server_process_duration_seconds", f'kind="{kind}"'))
+        caches = (("snapshot", repos_data), ("repo", repo_statuses))
+        metric("repos_server_cache_hits_total", "counter", "Lookups answered from a cache")
+        for name, cache in caches:
+            out.append(f'repos_server_cache_hits_total{{cache="{name}"}} {cache.hits}')
+        metric("repos_server_cache_misses_total", "counter", "Lookups that needed a computation")
+        for name, cache in caches:
+            out.append(f'repos_server_cache_misses_total{{cache="{name}"}} {cache.misses}')
+        metric("repos_server_status_computations_in_flight", "gauge", "Status computations in progress")
+        out.append(f'repos_server_status_computations_in_flight{{cache="snapshot"}} {int(repos_data.in_flight is not None)}')
+        out.append(f'repos_server_status_computations_in_flight{{cache="repo"}} {len(repo_statuses.in_flight)}')
+        if watcher is not None:
+            metric("repos_server_watched_repos", "gauge", "Repos whose git metadata is watched")
+            out.append(f'repos_server_watched_repos {len(watcher.names)}')
+            metric("repos_server_watched_changes_total", "counter", "Changes of repos seen by watching their git metadata")
+            out.append(f'repos_server_watched_changes_total {watcher.changes}')
+        return ''.join(l + '\n' for l in out).encode()
+
+def endpoint_of(path):
+    """ Name of the endpoint for the metrics so that labels have a small
+    number of values """
+    for prefix, endpoint in (("/repos-server/viewer", "viewer"), ("/repos-server/repo/", "repo")):
+        if path.startswith(prefix):
+            return endpoint
+    if path in ("/repos-server/repos-data", "/repos-server/repos-stream", "/repos-server/metrics"):
+        return path.rsplit('/', 1)[-1]
+    if path in ("/repos-server", "/repos-server/", "/"):
+        return "redirect"
+    return "other"
+
+class Asset:
+    """ A file of the viewer with everything needed to answer requests for it
+    without touching the disk.  For large files, data is None and the file is
+    read when sent. """
+    def __init__(self, fullpath):
+        self.fullpath = fullpath
+        st = os.stat(fullpath)
+        self.mtime_ns = st.st_mtime_ns
+        self.size = st.st_size
+        self.last_modified = email.utils.formatdate(st.st_mtime, usegmt=True)
+        self.content_type = content_types.get(fullpath.rsplit('.', 1)[-1], 'application/octet-stream')
+        self.data = None
+        self.gzip_data = None
+        if self.size > LARGE_FILE_SIZE:
+            self.etag = f'"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"'
+            return
+        with open(fullpath, 'rb') as f:
+            self.data = f.read()
+        self.size = len(self.data)
+        self.etag = f'"{hashlib.sha1(self.data).hexdigest()[:20]}"'
+        if self.size >= MIN_GZIP_SIZE:
+            compressed = gzip.compress(self.data, compresslevel=9, mtime=0)
+            if len(compressed) < self.size:
+                self.gzip_data = compressed
+
+    def changed(self):
+        try:
+            return os.stat(self.fullpath).st_mtime_ns != self.mtime_ns
+        except FileNotFoundError:
+            return True
+
+class StaticFiles:
+    """ The files of the viewer loaded in memory with their validators and
+    gzip compressed versions so that serving them is only writing bytes """
+    def __init__(self, root, reload=False):
+        self.root = root
+        self.reload = reload
+        self.lock = threading.Lock()
+        self.assets = {}
+        self.load()
+
+    def load(self):
+        assets = {}
+        for directory, _, files in os.walk(self.root):
+            for f in files:
+                fullpath = os.path.join(directory, f)
+                try:
+                    assets[os.path.relpath(fullpath, self.root)] = Asset(fullpath)
+                except OSError as e:
+                    print(f"Could not load '{fullpath}': {e}")
+        with self.lock:
+            self.assets = assets
+
+    def get(self, path):
+        """ Asset for path relative to root or None.  Without reload, only
+        files found when loading can be returned so paths can't escape root.
+        With reload, only the requested file is loaded again if it changed
+        or appeared. """
+        with self.lock:
+            asset = self.assets.get(path)
+        if self.reload and (asset is None or asset.changed()):
+            asset = self.reload_file(path)
+        return asset
+
+    def reload_file(self, path):
+        path = os.path.normpath(path)
+        if os.path.isabs(path) or path == '..' or path.startswith(os.path.join('..', '')):
+            return None
+        fullpath = os.path.join(self.root, path)
+        try:
+            asset = Asset(fullpath) if os.path.isfile(fullpath) else None
+        except OSError as e:
+            print(f"Could not load '{fullpath}': {e}")
+            asset = None
+        with self.lock:
+            if asset is None:
+                self.assets.pop(path, None)
+            else:
+                self.assets[path] = asset
+        return asset
+
+class Snapshot:
+    def __init__(self, data, started=None):
+        self.data = data
+        self.time = time.monotonic()
+        # When the computation of data started
+        self.started = self.time if started is None else started
+        self._etag = None
+
+    def etag(self):
+        """ ETag of a snapshot of the JSON of all repos """
+        if self._etag is None:
+            self._etag = etag_of(json.loads(self.data))
+        return self._etag
+
+    def age(self):
+        return time.monotonic() - self.time
+
+class SnapshotCache:
+    """ Keep the last result of compute() for ttl seconds.
+
+    Only one computation runs at a time: requests arriving while one is in
+    progress wait for it and all get its result instead of starting their
+    own.  A fresh request only shares a fresh computation that started after
+    it arrived, otherwise it waits for the one in progress and starts
+    another.  With refresh_interval, a background thread recomputes the snapshot
+    periodically so that requests rarely have to wait.
+
+    compute(fresh) is called with fresh True when a request asked for a
+    fresh snapshot. """
+    def __init__(self, compute, ttl, refresh_interval=0):
+        self.compute = compute
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self.snapshot = None
+        self.in_flight = None
+        # When the computation in progress started and if it is fresh
+        self.in_flight_started = None
+        self.in_flight_fresh = False
+        # Incremented by invalidate() so that a computation that started
+        # before does not store its result
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if refresh_interval > 0:
+            threading.Thread(target=self._refresh_loop, daemon=True).start()
+
+    def get(self, fresh=False):
+        """ Return a Snapshot no older than ttl, or one whose computation
+        started after this call if fresh is True.  Raises the exception of
+        compute() if it fails. """
+        requested = time.monotonic()
+        with self.lock:
+            snapshot = self.snapshot
+            if not fresh and snapshot is not None and snapshot.age() < self.ttl:
+                self.hits += 1
+                return snapshot
+            self.misses += 1
+        while True:
+            with self.lock:
+                snapshot = self.snapshot
+                if fresh and snapshot is not None and snapshot.started >= requested:
+                    # Computed by another fresh request that came after us
+                    return snapshot
+                if fresh and self.in_flight is not None and \
+                        (self.in_flight_started < requested or not self.in_flight_fresh):
+                    # Could have missed changes made before this call, wait
+                    # for it to finish and start another one
+                    future = self.in_flight
+                    stale = True
+                else:
+                    future = self._start(fresh)
+                    stale = False
+            if not stale:
+                return future.result()
+            concurrent.futures.wait([future])
+
+    def _start(self, fresh=False):
+        """ Return the computation in progress or start one, called with
+        self.lock held """
+        if self.in_flight is None:
+            future = concurrent.futures.Future()
+            self.in_flight = future
+            self.in_flight_started = time.monotonic()
+            self.in_flight_fresh = fresh
+            threading.Thread(target=self._run, args=(future, fresh, self.generation, self.in_flight_started),
+                             daemon=True).start()
+        return self.in_flight
+
+    def _run(self, future, fresh, generation, started):
+        try:
+            snapshot = Snapshot(self.compute(fresh), started)
+        except Exception as e:
+            with self.lock:
+                self.in_flight = None
+            future.set_exception(e)
+            return
+        with self.lock:
+            if generation == self.generation:
+                self.snapshot = snapshot
+            self.in_flight = None
+        future.set_result(snapshot)
+
+    def invalidate(self):
+        """ Forget the snapshot so that the next request computes one """
+        with self.lock:
+            self.snapshot = None
+            self.generation += 1
+
+    def put(self, data):
+        """ Store data computed by other means than compute().  It may come
+        from older results so it is never used for fresh requests. """
+        with self.lock:
+            self.snapshot = Snapshot(data, started=float('-inf'))
+
+    def _refresh_loop(self):
+        while True:
+            with self.lock:
+                future = self._start()
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Background refresh failed: {e}")
+            time.sleep(self.refresh_interval)
+
+def repos_command(repo_file, jobs):
+    cmd = ["repos", "-j", str(jobs), "-output-format", "json", "-branch"]
+    if repo_file:
+        cmd += ["-F", repo_file]
+    if args.no_fetch:
+        cmd.append("-no-fetch")
+    return cmd
+
+def load_repos():
+    """ The repos of the config file, also watched with --watch """
+    repos = _repos_config.load(args.repo_file, read_only=True)['repos']
+    if watcher is not None:
+        watcher.sync(repos)
+    return repos
+
+def compute_repos_data(fresh=False):
+    if args.engine == 'python':
+        repos = load_repos()
+        if watcher is not None:
+            # Only the repos that changed or whose status expired are computed
+            statuses = list(repo_statuses.get(sorted(repos.items()), fresh))
+        else:
+            statuses = list(_repos_status.statuses(repos.items(), fetch=not args.no_fetch, executor=status_pool))
+        statuses.sort(key=lambda st: st['Config']['Name'])
+        repo_statuses.update(statuses, complete=len(statuses) == len(repos))
+        return json.dumps(statuses).encode()
+    result = metrics.run("all", repos_command(args.repo_file, args.jobs), stdout=subprocess.PIPE)
+    if result.returncode != 0:
+        raise RuntimeError(f"repos exited with status {result.returncode}")
+    statuses = [add_last_commit_time(st) for st in json.loads(result.stdout)]
+    repo_statuses.update(statuses, complete=True)
+    return json.dumps(statuses).encode()
+
+def repo_status(name, repo):
+    """ Status of one repo in the format of 'repos -output-format json'.
+    With the Go engine, 'repos' is run on a config file containing only that
+    repo. """
+    if args.engine == 'python':
+        return _repos_status.repo_status(name, repo, fetch=not args.no_fetch)
+    with tempfile.NamedTemporaryFile('w', prefix='repos-server-', suffix='.yml') as f:
+        _repos_config.dump({'repos': {name: repo}}, f)
+        f.flush()
+        result = metrics.run("one", repos_command(f.name, 1), stdout=subprocess.PIPE)
+    if result.returncode != 0:
+        raise RuntimeError(f"repos exited with status {result.returncode} for repo '{name}'")
+    return add_last_commit_time(json.loads(result.stdout)[0])
+
+def add_last_commit_time(status):
+    """ Add the LastCommitTime of the Python engine to a status computed by
+    the Go program from its TimeSinceLastCommit.  It is rounded to the minute
+    so that it is the same each time the status is computed except when the
+    estimate crosses a minute. """
+    state = status['State']
+    if 'LastCommitTime' not in state:
+        estimate = time.time() - state['TimeSinceLastCommit'] / 1_000_000_000
+        state['LastCommitTime'] = int(estimate // 60 * 60)
+    return status
+
+def fingerprint(status):
+    """ Hash of a status that only changes when the repo changes.  The time
+    since the last commit grows each time the status is computed so it is
+    left out, the time of the last commit is there instead so that a new
+    commit that changes nothing else still changes the fingerprint. """
+    state = {k: v for k, v in status['State'].items() if k != 'TimeSinceLastCommit'}
+    return hashlib.sha1(json.dumps([status['Config'], state], sort_keys=True).encode()).hexdigest()
+
+def etag_of(statuses):
+    h = hashlib.sha1()
+    for fp in sorted((st['Config']['Name'], fingerprint(st)) for st in statuses):
+        h.update(repr(fp).encode())
+    return f'"{h.hexdigest()[:20]}"'
+
+class RepoStatusCache:
+    """ The status of each repo with the time it was computed so that
+    requests about some repos only compute the status of those that are not
+    known or older than ttl seconds.  It is also filled by the computations
+    of the status of all repos.
+
+    Like SnapshotCache, a repo whose status is being computed is not
+    computed again by other requests, they wait for the same result.
+
+    Each time the status of a repo changes (ignoring the time since the last
+    commit), the version is incremented and remembered for that repo so that
+    clients can ask for what changed since a version they already have.
+    Versions are prefixed with the time the server started so that versions
+    from before a restart are recognized.
+
+    The status of the repos in watched, whose changes are reported by
+    invalidate(), is kept for watched_ttl seconds instead of ttl. """
+    def __init__(self, compute, ttl, watched_ttl=None):
+        self.compute = compute
+        self.ttl = ttl
+        self.watched_ttl = ttl if watched_ttl is None else watched_ttl
+        self.watched = ()
+        self.statuses = {}
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.epoch = str(int(time.time()))
+        self.version = 0
+        self.fingerprints = {}
+        self.versions = {}
+        self.removed = {}
+        # Repos that changed while their status was being computed
+        self.stale = set()
+        # Time at which the last computation of each repo finished
+        self.finished = {}
+
+    def _store(self, name, status):
+        """ Called with self.lock held """
+        fp = fingerprint(status)
+        if self.fingerprints.get(name) != fp:
+            self.version += 1
+            self.fingerprints[name] = fp
+            self.versions[name] = self.version
+            self.removed.pop(name, None)
+        self.statuses[name] = Snapshot(status)
+
+    def update(self, statuses, complete=False):
+        """ Store statuses computed elsewhere.  If complete, statuses are those
+        of all repos and the others are forgotten. """
+        with self.lock:
+            for status in statuses:
+                self._store(status['Config']['Name'], status)
+            if complete:
+                names = {status['Config']['Name'] for status in statuses}
+                for name in [n for n in self.fingerprints if n not in names]:
+                    self.version += 1
+                    self.removed[name] = self.version
+                    del self.fingerprints[name]
+                    del self.versions[name]
+                    self.statuses.pop(name, None)
+
+    def current_version(self):
+        return f"{self.epoch}.{self.version}"
+
+    def changes(self, since):
+        """ (version, statuses of repos changed since the version since, names
+        of repos removed since then, True if since is not a version of this
+        server and everything is returned) """
+        epoch, _, number = (since or '').partition('.')
+        with self.lock:
+            full = epoch != self.epoch or not number.isdigit() or int(number) > self.version
+            since = 0 if full else int(number)
+            changed = [self.statuses[n].data for n, v in self.versions.items() if v > since and n in self.statuses]
+            removed = [n for n, v in self.removed.items() if v > since]
+            return self.current_version(), changed, removed, full
+
+    def cached(self, name, repo):
+        """ Snapshot of the status of repo if it is recent enough """
+        snapshot = self.statuses.get(name)
+        ttl = self.watched_ttl if name in self.watched else self.ttl
+        if snapshot is None or snapshot.age() >= ttl:
+            return None
+        if snapshot.data['Config']['Path'] != repo['path']:
+            return None
+        return snapshot
+
+    def get(self, repos, fresh=False):
+        """ Yield the status of each of the (name, repo) pairs of repos, known
+        ones first and then the others as soon as they are computed.  Repos
+        whose status could not be computed are skipped. """
+        ready = []
+        futures = []
+        with self.lock:
+            for name, repo in repos:
+                snapshot = None if fresh else self.cached(name, repo)
+                if snapshot is not None:
+                    self.hits += 1
+                    ready.append(snapshot.data)
+                    continue
+                self.misses += 1
+                future = self.in_flight.get(name)
+                if future is None:
+                    future = status_pool.submit(self._run, name, repo)
+                    self.in_flight[name] = future
+                futures.append(future)
+        yield from ready
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                yield future.result()
+            except Exception as e:
+                print(f"Could not get status: {e}")
+
+    def _run(self, name, repo):
+        try:
+            status = self.compute(name, repo)
+            with self.lock:
+                self._store(name, status)
+            return status
+        finally:
+            with self.lock:
+                self.in_flight.pop(name, None)
+                self.finished[name] = time.monotonic()
+                if name in self.stale:
+                    self.stale.discard(name)
+                    self.statuses.pop(name, None)
+                    self.in_flight[name] = status_pool.submit(self._run, name, repo)
+
+    def invalidate(self, repos):
+        """ Forget the status of the (name, repo) pairs of repos and compute
+        it again in the background.  A repo whose status is being computed is
+        computed again when done since it may have missed the change. """
+        with self.lock:
+            for name, repo in repos:
+                self.statuses.pop(name, None)
+                if name in self.in_flight:
+                    self.stale.add(name)
+                else:
+                    self.in_flight[name] = status_pool.submit(self._run, name, repo)
+
+    def busy(self, name, within):
+        """ True if the status of the repo is being computed or was computed
+        less than within seconds ago """
+        with self.lock:
+            if name in self.in_flight:
+                return True
+            return time.monotonic() - self.finished.get(name, float('-inf')) < within
+
+class RepoWatcher:
+    """ Watch the files that git changes when the state of a repo changes
+    with inotify so that the status of a repo is only computed again when it
+    changed: HEAD and index in the git directory, packed-refs and everything
+    under refs.  Changes to files of the working tree that are not staged
+    don't touch these files and are only seen when the status expires.
+
+    Directories are watched rather than files because git replaces these
+    files by renaming a lock file over them.
+
+    Refs under refs/remotes and refs/tags and packed-refs are updated by the
+    'git fetch' of the server itself so changes to them are ignored for
+    repos whose status is being computed or was just computed. """
+    MASK = (_repos_inotify.IN_CREATE | _repos_inotify.IN_DELETE
+            | _repos_inotify.IN_MOVED_FROM | _repos_inotify.IN_MOVED_TO
+            | _repos_inotify.IN_CLOSE_WRITE | _repos_inotify.IN_ONLYDIR)
+    GIT_DIR_FILES = {'HEAD', 'index', 'packed-refs'}
+    FETCHED_REFS = {'remotes', 'tags'}
+    # Time to wait for more events after the first one of a batch
+    BATCH_DELAY = 0.2
+    # Seconds after the computation of the status of a repo during which
+    # changes to fetched refs are attributed to the server
+    GRACE = 2
+
+    def __init__(self, on_change, busy):
+        self.on_change = on_change
+        self.busy = busy
+        self.inotify = _repos_inotify.Inotify()
+        self.lock = threading.Lock()
+        self.repos = {}
+        self.paths = {}
+        # Names of the repos whose git metadata is completely watched and of
+        # the ones that lost a watch because a directory was deleted, they
+        # are watched again as soon as it is possible
+        self.names = set()
+        self.lost = set()
+        # wd -> (directory, kind) where kind is 'git' for git directories,
+        # 'refs' for refs directories, 'fetched' for directories under
+        # refs/remotes or refs/tags and 'local' for other directories under
+        # refs
+        self.watches = {}
+        self.wds = {}
+        # Directory -> names of the repos using it, several linked worktrees
+        # share the same refs
+        self.dir_names = collections.defaultdict(set)
+        self.changes = 0
+
+    def sync(self, repos):
+        """ Watch the repos of the dict repos and stop watching the others """
+        paths = {name: repo['path'] for name, repo in repos.items()}
+        with self.lock:
+            self.repos = dict(repos)
+            if paths == self.paths:
+                self._rewatch()
+                return
+            for name, path in self.paths.items():
+                if paths.get(name) != path:
+                    self._unwatch(name)
+            for name, path in paths.items():
+                if self.paths.get(name) != path:
+                    self._watch(name, path)
+            self.paths = paths
+            self._rewatch()
+
+    def _watch(self, name, path, quiet=False):
+        dirs = _repos_base.get_git_dirs(os.path.expanduser(path))
+        if dirs is None:
+            if not quiet:
+                print(f"Cannot watch repo '{name}': '{path}' is not a git repo")
+            return False
+        git_dir, common_dir = dirs
+        if (self._add(git_dir, 'git', name, quiet) and self._add(common_dir, 'git', name, quiet)
+                and self._add_tree(os.path.join(common_dir, 'refs'), 'refs', name, quiet)):
+            self.names.add(name)
+            return True
+        return False
+
+    def _rewatch(self):
+        """ Try again to watch the repos that lost a watch, the directory
+        that was deleted may have been created again """
+        for name in sorted(self.lost):
+            if name not in self.paths:
+                self.lost.discard(name)
+            elif self._watch(name, self.paths[name], quiet=True):
+                self.lost.discard(name)
+
+    def _add(self, directory, kind, name, quiet=False):
+        if directory not in self.wds:
+            try:
+                wd = self.inotify.add_watch(directory, self.MASK)
+            except OSError as e:
+                if quiet and e.errno == errno.ENOENT:
+                    return False
+                if e.errno == errno.ENOSPC:
+                    print(f"Cannot watch '{directory}': inotify watch limit reached, see /proc/sys/fs/inotify/max_user_watches")
+                else:
+                    print(f"Cannot watch '{directory}': {e}")
+                return False
+            self.watches[wd] = (directory, kind)
+            self.wds[directory] = wd
+        self.dir_names[directory].add(name)
+        return True
+
+    def _add_tree(self, directory, kind, name, quiet=False):
+        if not self._add(directory, kind, name, quiet):
+            return False
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            return True
+        ok = True
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                ok = self._add_tree(entry.path, self.child_kind(kind, entry.name), name, quiet) and ok
+        return ok
+
+    def child_kind(self, kind, name):
+        if kind == 'refs':
+            return 'fetched' if name in self.FETCHED_REFS else 'local'
+        return kind
+
+    def _unwatch(self, name):
+        self.names.discard(name)
+        self.lost.discard(name)
+        for directory in [d for d, names in self.dir_names.items() if name in names]:
+            names = self.dir_names[directory]
+            names.discard(name)
+            if names:
+                continue
+            del self.dir_names[directory]
+            wd = self.wds.pop(directory, None)
+            if wd is not None:
+                self.watches.pop(wd, None)
+                self.inotify.rm_watch(wd)
+
+    def _lose(self, directory, changed):
+        """ Stop watching directory and the directories under it.  Their
+        repos are no longer completely watched so their status expires
+        normally until _rewatch() succeeds, and whatever removed the
+        directory probably changed them. """
+        prefix = os.path.join(directory, '')
+        for d in [d for d in self.wds if d == directory or d.startswith(prefix)]:
+            wd = self.wds.pop(d)
+            self.watches.pop(wd, None)
+            self.inotify.rm_watch(wd)
+            names = self.dir_names.pop(d, set())
+            self.names -= names
+            self.lost |= names
+            changed.update(names)
+
+    def handle(self, event, changed):
+        """ Add the names of the repos changed by event to changed, called
+        with self.lock held """
+        if event.mask & _repos_inotify.IN_Q_OVERFLOW:
+            print(f"Too many inotify events, considering that all repos changed")
+            changed.update(self.repos)
+            return
+        if event.wd not in self.watches:
+            return
+        directory, kind = self.watches[event.wd]
+        if event.mask & _repos_inotify.IN_IGNORED:
+            # The directory was deleted
+            self._lose(directory, changed)
+            return
+        if event.mask & _repos_inotify.IN_ISDIR and event.mask & _repos_inotify.IN_MOVED_FROM:
+            # A watch follows its directory when it is moved away
+            self._lose(os.path.join(directory, event.name), changed)
+        if event.name.endswith('.lock'):
+            return
+        names = self.dir_names.get(directory, ())
+        if kind == 'git':
+            if event.name not in self.GIT_DIR_FILES:
+                return
+            fetched = event.name == 'packed-refs'
+        else:
+            if event.mask & _repos_inotify.IN_ISDIR and event.mask & (_repos_inotify.IN_CREATE | _repos_inotify.IN_MOVED_TO):
+                for name in list(names):
+                    self._add_tree(os.path.join(directory, event.name), self.child_kind(kind, event.name), name)
+            fetched = self.child_kind(kind, event.name) == 'fetched'
+        if fetched:
+            names = [n for n in names if not self.busy(n, self.GRACE)]
+        changed.update(names)
+
+    def run(self):
+        while True:
+            events = self.inotify.read()
+            while True:
+                more = self.inotify.read(timeout=self.BATCH_DELAY)
+                if not more:
+                    break
+                events += more
+            changed = set()
+            with self.lock:
+                for event in events:
+                    self.handle(event, changed)
+                self._rewatch()
+                repos = [(name, self.repos[name]) for name in sorted(changed) if name in self.repos]
+                self.changes += len(repos)
+            if repos:
+                self.on_change(repos)
+
+def repos_changed(repos):
+    print(f"Repos changed: {', '.join(name for name, _ in repos)}")
+    repo_statuses.invalidate(repos)
+    repos_data.invalidate()
+
+def is_under(path, directory):
+    path = os.path.normpath(os.path.expanduser(path))
+    return path == directory or path.startswith(os.path.join(directory, ''))
+
+def query_flag(query, key):
+    return query.get(key, ['0'])[-1] not in ('', '0')
+
+class Selection:
+    """ The repos selected by the query parameters of a request:
+
+        under=PATH  Only repos under PATH, selected before computing status
+        dirty=1     Only repos with staged, unstaged or untracked changes
+        behind=1    Only repos behind their remote
+    """
+    def __init__(self, query):
+        self.under = query.get('under', [None])[-1]
+        if self.under:
+            self.under = os.path.normpath(os.path.expanduser(self.under))
+        self.dirty = query_flag(query, 'dirty')
+        self.behind = query_flag(query, 'behind')
+
+    def all(self):
+        return not (self.under or self.dirty or self.behind)
+
+    def repos(self, repos):
+        return [(name, repo) for name, repo in sorted(repos.items())
+                if not self.under or is_under(repo['path'], self.under)]
+
+    def matches(self, status):
+        state = status['State']
+        if self.dirty and not (state['Dirty'] or state['StagedChanges']
+                               or state['UntrackedFiles'] or state['UntrackedDirs']):
+            return False
+        if self.behind and not state['RemoteState']['Behind'] > 0:
+            return False
+        return True
+
 class MyServer(http.server.BaseHTTPRequestHandler):
     def allow_origin(self):
         if "*" in args.allowed_origins:
@@ -34,26 +852,202 @@ class MyServer(http.server.BaseHTTPRequestHandler):
         if 'Origin' not in self.headers:
             print(f"Refusing because: Origin not in self.headers: \n\033[36m{str(self.headers).strip()}\033[0m")
             self.send_response(403)
+            self.end_headers()
             return False
 
         if self.headers['Origin'] not in args.allowed_origins:
             print(f"Refusing because origin: {self.headers['Origin']} not in allowed origins: {args.allowed_origins}")
             self.send_response(403)
+            self.end_headers()
             return False
         return True
 
-    def serve_viewer(self):
-        path=self.path.replace("..", "NOPE").replace("~", "Ah Ah Ah")
-        path = path[len("/repos-server/"):]
+    def serve_viewer(self, path):
+        asset = static_files.get(path[len("/repos-server/"):])
+        if asset is None:
+            print(f"Requested file '{path}' not found")
+            self.send_error(404)
+            return
+        gzip_ok = asset.gzip_data is not None and 'gzip' in self.headers.get('Accept-Encoding', '')
+        etag = f'{asset.etag[:-1]}-gz"' if gzip_ok else asset.etag
+        if self.not_modified(etag, asset):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', asset.last_modified)
+            self.end_headers()
+            return
+        if asset.data is None:
+            # Large files are read when sent: the file is opened first so
+            # that its current size is used and a missing file is a 404
+            try:
+                f = open(asset.fullpath, 'rb')
+            except OSError as e:
+                print(f"Could not open '{asset.fullpath}': {e}")
+                self.send_error(404)
+                return
         self.send_response(200)
-        ext = path.rsplit('.', 1)[-1]
-        self.send_header('Content-Type', content_types[ext])
-        self.end_headers()
-        fullpath = f"{repos_root}/share/repos/html/{path}"
-        if os.path.isfile(fullpath):
-            self.wfile.write(open(fullpath, 'rb').read())
+        self.send_header('Content-Type', asset.content_type)
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', asset.last_modified)
+        self.send_header('Cache-Control', 'no-cache')
+        if asset.gzip_data is not None:
+            self.send_header('Vary', 'Accept-Encoding')
+        if gzip_ok:
+            self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(asset.gzip_data)))
+            self.end_headers()
+            self.wfile.write(asset.gzip_data)
+        elif asset.data is not None:
+            self.send_header('Content-Length', str(asset.size))
+            self.end_headers()
+            self.wfile.write(asset.data)
         else:
-            print(f"Requested file '{path}' not found")
+            with f:
+                size = os.fstat(f.fileno()).st_size
+                self.send_header('Content-Length', str(size))
+                self.end_headers()
+                self.wfile.flush()
+                self.connection.sendfile(f, count=size)
+
+    def not_modified(self, etag, asset):
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            return etag in [t.strip() for t in if_none_match.split(',')] or if_none_match.strip() == '*'
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since is not None:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return asset.mtime_ns // 1_000_000_000 <= since
+        return False
+
+    def send_json(self, data, age=None, etag=None):
+        self.send_response(200)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('X-Repos-Version', repo_statuses.current_version())
+        if etag is not None:
+            self.send_header('ETag', etag)
+        if age is not None:
+            self.send_header('Age', str(int(age)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def etag_matches(self, etag):
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is None:
+            return False
+        return etag in [t.strip() for t in if_none_match.split(',')] or if_none_match.strip() == '*'
+
+    def send_not_modified(self, etag):
+        self.send_response(304)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('ETag', etag)
+        self.send_header('X-Repos-Version', repo_statuses.current_version())
+        self.end_headers()
+
+    def send_status_error(self, code, message):
+        print(message)
+        self.send_response(code)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+
+    def serve_repos_data(self, query):
+        """ The status of all repos or those selected by the query as a JSON
+        array with an ETag that only changes when the status of a repo
+        changes.  With since=VERSION, only what changed since VERSION. """
+        fresh = query_flag(query, 'fresh')
+        selection = Selection(query)
+        if 'since' in query or not selection.all():
+            repos = selection.repos(load_repos())
+            if selection.all():
+                # Fill the cache with one computation for all repos, the
+                # delta is then made from what it stored
+                try:
+                    repos_data.get(fresh=fresh)
+                except Exception as e:
+                    self.send_status_error(502, f"Could not get the status of the repos: {e}")
+                    return
+            else:
+                statuses = list(repo_statuses.get(repos, fresh))
+        if 'since' in query:
+            self.serve_delta(query['since'][-1], selection, {name for name, _ in repos})
+            return
+        if not selection.all():
+            statuses = sorted((st for st in statuses if selection.matches(st)), key=lambda st: st['Config']['Name'])
+            etag = etag_of(statuses)
+            if self.etag_matches(etag):
+                self.send_not_modified(etag)
+                return
+            self.send_json(json.dumps(statuses).encode(), etag=etag)
+            return
+        try:
+            snapshot = repos_data.get(fresh=fresh)
+        except Exception as e:
+            self.send_status_error(502, f"Could not get the status of the repos: {e}")
+            return
+        if self.etag_matches(snapshot.etag()):
+            self.send_not_modified(snapshot.etag())
+            return
+        self.send_json(snapshot.data, snapshot.age(), snapshot.etag())
+
+    def serve_delta(self, since, selection, names):
+        """ Send {"version": V, "full": F, "changed": [...], "removed": [...]}
+        with the statuses of the selected repos that changed since the version
+        since and the names of the ones that were removed or that stopped
+        matching the selection.  If since is not a version of this server,
+        full is true and all the selected repos are in changed. """
+        version, changed, removed, full = repo_statuses.changes(since)
+        changed = [st for st in changed if st['Config']['Name'] in names]
+        removed += [st['Config']['Name'] for st in changed if not selection.matches(st)]
+        changed = [st for st in changed if selection.matches(st)]
+        changed.sort(key=lambda st: st['Config']['Name'])
+        data = {'version': version, 'full': full, 'changed': changed, 'removed': sorted(removed)}
+        self.send_json(json.dumps(data).encode())
+
+    def serve_repo(self, name, query):
+        repo = load_repos().get(name)
+        if repo is None:
+            self.send_status_error(404, f"No repo named '{name}'")
+            return
+        statuses = list(repo_statuses.get([(name, repo)], query_flag(query, 'fresh')))
+        if not statuses:
+            self.send_status_error(502, f"Could not get the status of repo '{name}'")
+            return
+        with repo_statuses.lock:
+            snapshot = repo_statuses.statuses.get(name)
+        etag = etag_of(statuses)
+        if self.etag_matches(etag):
+            self.send_not_modified(etag)
+            return
+        self.send_json(json.dumps(statuses[0]).encode(), snapshot.age() if snapshot else None, etag)
+
+    def serve_repos_stream(self, query):
+        """ Send the status of repos as newline delimited JSON, one repo per
+        line: the ones already known first and then the others in the order
+        in which they finish """
+        selection = Selection(query)
+        repos = selection.repos(load_repos())
+        self.send_response(200)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        statuses = []
+        try:
+            for status in repo_statuses.get(repos, query_flag(query, 'fresh')):
+                statuses.append(status)
+                if selection.matches(status):
+                    self.wfile.write(json.dumps(status).encode() + b'\n')
+        except (BrokenPipeError, ConnectionResetError):
+            print(f"Client went away while streaming")
+            return
+        # Use what we computed for the next repos-data requests
+        if selection.all() and len(statuses) == len(repos):
+            repos_data.put(json.dumps(statuses).encode())
 
     def do_OPTIONS(self):
         """Assume that requests with method GET are CORS preflight requests"""
@@ -68,28 +1062,57 @@ class MyServer(http.server.BaseHTTPRequestHandler):
         self.send_header('Access-Control-Max-Age', '86400')
         self.end_headers()
 
+    def send_response(self, code, message=None):
+        self.status_code = code
+        super().send_response(code, message)
+
     def do_GET(self):
+        self.status_code = 0
+        with metrics.request(endpoint_of(urllib.parse.urlsplit(self.path).path)) as result:
+            try:
+                self.handle_get()
+            finally:
+                result['code'] = self.status_code
+
+    def serve_metrics(self):
+        data = metrics.text()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_get(self):
         if self.path in ["/repos-server", "/repos-server/", "/"]:
             self.send_response(301)
             self.send_header("Location", "/repos-server/viewer/repos.html")
             self.end_headers()
             return
         # print(f"path = {self.path}")
-        if self.path.startswith("/repos-server/viewer"):
-            self.serve_viewer()
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        if url.path.startswith("/repos-server/viewer"):
+            self.serve_viewer(url.path)
+            return
+
+        # For scrapers which don't send the headers of browsers
+        if url.path == "/repos-server/metrics":
+            self.serve_metrics()
             return
 
         if not self.allow_origin():
             return
 
-        if self.path == "/repos-server/repos-data":
-            self.send_response(200)
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            subprocess.run(
-                ["repos", "-j", "20", "-output-format", "json", "-branch"],
-                stdout=self.wfile
-            )
+        if url.path == "/repos-server/repos-data":
+            self.serve_repos_data(query)
+            return
+
+        if url.path == "/repos-server/repos-stream":
+            self.serve_repos_stream(query)
+            return
+
+        if url.path.startswith("/repos-server/repo/"):
+            self.serve_repo(urllib.parse.unquote(url.path[len("/repos-server/repo/"):]), query)
             return
 
         self.send_response(500)
@@ -98,10 +1121,80 @@ class MyServer(http.server.BaseHTTPRequestHandler):
         self.wfile.write(b'<H1>Unknown end point')
 
 
-try:
-    args = get_args()
-    server = http.server.HTTPServer((args.host, args.port), MyServer)
-    print(f"Server listening on address : \033[1;33m{args.host}\033[0m, port \033[1;34m{args.port}\033[0m")
-    server.serve_forever()
-except KeyboardInterrupt:
-    quit(130)
+class PoolHTTPServer(http.server.HTTPServer):
+    """ HTTP server handling requests in a fixed size pool of threads so that
+    a slow request does not block the others while the number of requests
+    running at the same time stays bounded.
+
+    Requests arriving when all workers are busy wait in the queue of the
+    pool.  On shutdown, no new connections are accepted and the requests in
+    progress are given some time to finish. """
+    def __init__(self, address, handler, workers):
+        super().__init__(address, handler)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="repos-server")
+        self.in_flight = set()
+        self.lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        future = self.executor.submit(self.process_request_thread, request, client_address)
+        with self.lock:
+            self.in_flight.add(future)
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        with self.lock:
+            self.in_flight.discard(future)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def drain(self, timeout):
+        """ Wait for requests in progress to finish, return the number of
+        those that did not finish in time """
+        with self.lock:
+            pending = list(self.in_flight)
+        _, not_done = concurrent.futures.wait(pending, timeout=timeout)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        return len(not_done)
+
+def stop_on_signal(server):
+    def handler(signum, frame):
+        print(f"Received signal {signal.Signals(signum).name}, shutting down")
+        # shutdown() waits for serve_forever() to return so it can't be
+        # called from the thread running serve_forever()
+        threading.Thread(target=server.shutdown).start()
+    signal.signal(signal.SIGTERM, handler)
+    signal.signal(signal.SIGINT, handler)
+
+args = get_args()
+metrics = Metrics()
+_repos_status.set_process_observer(lambda command, code, duration: metrics.process(f"git-{command}", code, duration))
+static_files = StaticFiles(f"{repos_root}/share/repos/html", reload=args.reload_static)
+status_pool = concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs, thread_name_prefix="repos-status")
+repo_statuses = RepoStatusCache(repo_status, args.cache_ttl, args.watch_ttl if args.watch else None)
+repos_data = SnapshotCache(compute_repos_data, args.cache_ttl, args.refresh_interval)
+watcher = None
+if args.watch:
+    try:
+        watcher = RepoWatcher(repos_changed, repo_statuses.busy)
+    except OSError as e:
+        print(f"Cannot watch repos: {e}")
+        sys.exit(1)
+    repo_statuses.watched = watcher.names
+    load_repos()
+    threading.Thread(target=watcher.run, daemon=True).start()
+    print(f"Watching {len(watcher.names)} repos with {len(watcher.watches)} inotify watches")
+server = PoolHTTPServer((args.host, args.port), MyServer, args.workers)
+stop_on_signal(server)
+print(f"Server listening on address : \033[1;33m{args.host}\033[0m, port \033[1;34m{args.port}\033[0m with {args.workers} workers")
+server.serve_forever()
+server.server_close()
+unfinished = server.drain(args.shutdown_timeout)
+if unfinished:
+    print(f"Giving up on {unfinished} requests still in progress after {args.shutdown_timeout}s")
+    os._exit(1)
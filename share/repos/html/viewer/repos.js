@@ -28,74 +28,118 @@ let shouldPrint = function(r, show_ignored){
     return false
 }
 
+let compareNames = function(r, s){
+    const nr = r.Config.Name.toUpperCase();
+    const ns = s.Config.Name.toUpperCase();
+    if(nr < ns){
+        return -1;
+    } else if (nr > ns){
+        return 1;
+    } else {
+        return 0;
+    }
+}
+
+let makeRow = function(r){
+    let row = document.createElement("tr")
+    let branch = r.State.CurrentBranch
+    if(branch.startsWith("((")){
+        branch = `<td class="repo-hash">${r.State.CurrentBranch}</td>`
+    } else {
+        branch = `<td class="repo-branch">${r.State.CurrentBranch}</td>`
+    }
+    let ahead = ""
+    let behind = ""
+    if(r.State.RemoteState.Ahead > 0){
+        ahead = `+${r.State.RemoteState.Ahead}`
+    }
+    if(r.State.RemoteState.Behind > 0) {
+        behind = `-${r.State.RemoteState.Behind}`
+    }
+    let stagedChanges = ""
+    let unstagedChanges = ""
+    if(r.State.StagedChanges) {
+        stagedChanges = `(${r.State.StagedFiles}f, +${r.State.StagedInsertions}, -${r.State.StagedDeletions})`
+    }
+    if(r.State.Dirty) {
+        unstagedChanges = `(${r.State.Files}f, +${r.State.Insertions}, -${r.State.Deletions})`
+    }
+    let untrackedFiles = ""
+    if(r.State.UntrackedFiles || r.State.UntrackedDirs){
+        untrackedFiles = `${r.State.UntrackedDirs}d,${r.State.UntrackedFiles}f`
+    }
+    let timeSinceLastCommit = r.State.TimeSinceLastCommit / 3600000000000
+    timeSinceLastCommit = timeSinceLastCommit.toFixed(2)
+    row.innerHTML = `<td class="repo-name">${r.Config.Name}</td>
+                     ${branch}
+                     <td class="repo-remote-state">${ahead}${behind}</td>
+                     <td class="repo-staged-changes">${stagedChanges}</td>
+                     <td class="repo-unstaged-changes">${unstagedChanges}</td>
+                     <td class="repo-untracked-files">${untrackedFiles}</td>
+                     <td class="repo-time-since-last-commit">${timeSinceLastCommit} hours</td>`
+    return row
+}
+
+/*
+ * Insert the row for r in the table keeping the rows sorted by name.  shown
+ * is the sorted list of repos that have a row in the table.
+ */
+let insertRow = function(table, shown, r){
+    let i = shown.findIndex((s) => compareNames(r, s) < 0)
+    let row = makeRow(r)
+    if(i < 0){
+        shown.push(r)
+        table.appendChild(row)
+    } else {
+        table.insertBefore(row, table.rows[i])
+        shown.splice(i, 0, r)
+    }
+}
+
+/*
+ * The server sends one JSON object per line as soon as the status of each
+ * repo is known so we add rows as lines arrive instead of waiting for the
+ * whole response.
+ */
 let reposServerRequest = function(){
-    let req = new XMLHttpRequest();
-    req.onreadystatechange = function(){
-        if(this.readyState != 4){return;}
-        if(this.status != 200){console.log(this); return;}
+    let all_button = document.getElementById("repos-control-all")
+    let ignore_button = document.getElementById("repos-control-ignore")
+    let table = document.getElementById("repos-table-body")
+    table.innerHTML = ""
+    let resp = []
+    let shown = []
+    let received = 0
 
-        let all_button = document.getElementById("repos-control-all")
-        let ignore_button = document.getElementById("repos-control-ignore")
-        resp = JSON.parse(this.responseText);
-        highlighted = syntaxHighlight(JSON.stringify(resp, undefined, 2))
-        document.getElementById('repos-server-response').innerHTML = highlighted
-        let table = document.getElementById("repos-table-body")
-        table.innerHTML = ""
-        resp.sort((r,s) => {
-            const nr = r.Config.Name.toUpperCase();
-            const ns = s.Config.Name.toUpperCase();
-            if(nr < ns){
-                return -1;
-            } else if (nr > ns){
-                return 1;
-            } else {
-                return 0;
+    let handleLines = function(text, final){
+        let end = final ? text.length : text.lastIndexOf("\n") + 1
+        if(end <= received){return;}
+        text.substring(received, end).split("\n").forEach( (line) => {
+            if(line.trim() == ""){
+                return
             }
-        })
-        resp.forEach( (r) => {
+            let r = JSON.parse(line)
+            resp.push(r)
             if(!all_button.checked && !shouldPrint(r, ignore_button.checked)){
                 return // it's a callback so this is a continue
             }
-            let row = document.createElement("tr")
-            table.appendChild(row)
-            let branch = r.State.CurrentBranch
-            if(branch.startsWith("((")){
-                branch = `<td class="repo-hash">${r.State.CurrentBranch}</td>`
-            } else {
-                branch = `<td class="repo-branch">${r.State.CurrentBranch}</td>`
-            }
-            let ahead = ""
-            let behind = ""
-            if(r.State.RemoteState.Ahead > 0){
-                ahead = `+${r.State.RemoteState.Ahead}`
-            }
-            if(r.State.RemoteState.Behind > 0) {
-                behind = `-${r.State.RemoteState.Behind}`
-            }
-            let stagedChanges = ""
-            let unstagedChanges = ""
-            if(r.State.StagedChanges) {
-                stagedChanges = `(${r.State.StagedFiles}f, +${r.State.StagedInsertions}, -${r.State.StagedDeletions})`
-            }
-            if(r.State.Dirty) {
-                unstagedChanges = `(${r.State.Files}f, +${r.State.Insertions}, -${r.State.Deletions})`
-            }
-            let untrackedFiles = ""
-            if(r.State.UntrackedFiles || r.State.UntrackedDirs){
-                untrackedFiles = `${r.State.UntrackedDirs}d,${r.State.UntrackedFiles}f`
-            }
-            let timeSinceLastCommit = r.State.TimeSinceLastCommit / 3600000000000
-            timeSinceLastCommit = timeSinceLastCommit.toFixed(2)
-            row.innerHTML = `<td class="repo-name">${r.Config.Name}</td>
-                             ${branch}
-                             <td class="repo-remote-state">${ahead}${behind}</td>
-                             <td class="repo-staged-changes">${stagedChanges}</td>
-                             <td class="repo-unstaged-changes">${unstagedChanges}</td>
-                             <td class="repo-untracked-files">${untrackedFiles}</td>
-                             <td class="repo-time-since-last-commit">${timeSinceLastCommit} hours</td>`
+            insertRow(table, shown, r)
         })
+        received = end
+    }
+
+    let req = new XMLHttpRequest();
+    req.onprogress = function(){
+        handleLines(this.responseText, false)
+    }
+    req.onreadystatechange = function(){
+        if(this.readyState != 4){return;}
+        if(this.status != 200){console.log(this); return;}
+        handleLines(this.responseText, true)
+        resp.sort(compareNames)
+        highlighted = syntaxHighlight(JSON.stringify(resp, undefined, 2))
+        document.getElementById('repos-server-response').innerHTML = highlighted
     };
 
-    req.open('GET', '/repos-server/repos-data');
+    req.open('GET', '/repos-server/repos-stream');
     req.send();
 };